@@ -12,11 +12,21 @@ import matplotlib.pyplot as plt
 from warnings import warn
 
 import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import min_weight_full_bipartite_matching
+from scipy.special import gammaln
+from scipy.stats import norm
 import statsmodels.api as sm
 import statsmodels.formula.api as smf
 
 import osmnx as ox
 
+import os
+import heapq
+import hashlib
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+
 # Columns NOT to match on
 EXCLUDE_LIST = ['YEAR', 'STATE', 'STATEA', 
                 'COUNTY', 'COUNTYA', 'TRACTA', 
@@ -34,6 +44,50 @@ KNN_WITH_REPLACEMENT = False
 PROP_MATCHER = 'propensity_logit'
 N_FEATURES = 15
 
+# Constants for the built in matcher (see caliper_match)
+MATCH_METHODS = ['greedy', 'optimal']
+OPTIMAL_CANDIDATES = 10
+# Optimal matching scales badly (300k units takes the better part of a
+# minute), so warn past this many treated slots
+OPTIMAL_WARN_SLOTS = 50_000
+
+# Constants for the resampling engine (see resample_inference)
+IRLS_MAX_ITER = 100
+IRLS_TOL = 1e-8
+REPLICATE_CHUNK = 50
+OUTCOMES = {'crash': 'n_crashes', '311': 'n_311s'}
+
+# Search range for maximum likelihood alpha, on the log scale
+ML_LOG_ALPHA_BOUNDS = (-12.0, 4.0)
+ML_ALPHA_ITER = 60
+
+# Tract x year x category counts written by scripts/attach_crashes_cities.py
+COUNT_CUBE_LOC = '../../data/outcomes/tract_counts.npz'
+
+# Projected city boundaries, so each is only geocoded once
+BOUNDARY_CACHE = '../../data/shapes/boundaries'
+
+# Seed for everything random in matching, so reruns give the same matches
+SEED = 42
+
+# The cities we match within: (name in results, name in covariates, STATE in
+# the census, OSM boundary query). The names follow the notebooks' outputs.
+CITY_SPECS = [
+    ('Chicago', 'Chicago', 'Illinois', 'Chicago, Illinois'),
+    ('New York', 'New York City', 'New York', 'New York, New York'),
+    ('Detroit', 'Detroit', 'Michigan', 'Detroit, Michigan'),
+    ('Los Angeles', 'Los Angeles', 'California', 'Los Angeles, California'),
+    ('Philadelphia', 'Philadelphia', 'Pennsylvania', 'Philadelphia, Pennsylvania'),
+]
+
+# Treatment definitions: (column to recode, recoding into 0/1)
+TREATMENT_DEFINITIONS = {
+    'grade': ('grade', dict(A=0, B=0, C=1, D=1)),
+    'race': ('treatment_', dict(A=0, B=0, C=0, D=0, B_black=1, C_black=1, D_black=1)),
+}
+
+RESULT_COLUMNS = ['city', '311_coef', '311_se', '311_p', 'crash_coef', 'crash_se', 'crash_p']
+
 def feature_selection(df: pd.DataFrame, exclude_list: list[str]=EXCLUDE_LIST,
                       n_features: int=N_FEATURES, return_importances: bool=False,
                       outcome: str='treatment_') -> list[str]:
@@ -85,7 +139,31 @@ def display_cor_plot(df: pd.DataFrame, covariates: list[str],
     plt.title('Correlation Matrix', fontsize=16)
     plt.show()
 
-def make_psmpy(data: pd.DataFrame, treatment: str, outcome: str, index='GISJOIN') -> PsmPy:
+def load_count_cube(path: str=COUNT_CUBE_LOC) -> dict:
+    '''
+    Load the tract x year x category count cube into a dict holding the
+    counts array and its 'tracts' (GISJOIN), 'years' and 'categories' labels.
+    '''
+    with np.load(path) as cube:
+        return {name: cube[name] for name in cube.files}
+
+def slice_cube(cube: dict, name: str, years: list[int]=None,
+               categories: list[str]=None) -> pd.Series:
+    '''
+    Sum the count cube over the given years and categories (all of them by
+    default) into a per tract outcome column called name, indexed by GISJOIN.
+    e.g. slice_cube(cube, 'n_graffiti_2020', [2020], ['graffiti'])
+    '''
+    year_mask = np.ones(len(cube['years']), dtype=bool) if years is None \
+        else np.isin(cube['years'], years)
+    category_mask = np.ones(len(cube['categories']), dtype=bool) if categories is None \
+        else np.isin(cube['categories'], categories)
+
+    counts = cube['counts'][:, year_mask][:, :, category_mask].sum(axis=(1, 2))
+    return pd.Series(counts, index=pd.Index(cube['tracts'], name='GISJOIN'), name=name)
+
+def make_psmpy(data: pd.DataFrame, treatment: str, outcome: str, index='GISJOIN',
+               seed: int=SEED) -> PsmPy:
     '''
     Run propensity matching on the given dataset and return matched result.
     '''
@@ -102,47 +180,540 @@ def make_psmpy(data: pd.DataFrame, treatment: str, outcome: str, index='GISJOIN'
         warn("Found missing outcome values. Filling with 0")
         data[outcome] = data[outcome].fillna(0)
 
-    return PsmPy(data, treatment, target=outcome, indx=index, exclude=[outcome], seed=42)
+    return PsmPy(data, treatment, target=outcome, indx=index, exclude=[outcome], seed=seed)
 
 def retrieve_matches(psmpy: PsmPy, original_df: pd.DataFrame,
                      outcomes: list[str]=['n_crashes', 'n_311s'], treatment: str='treatment_') -> pd.DataFrame:
     '''
-    Given a psmpy object which has already done matching and the original
-    dataframe on which the matching was done, retrieve the relevant output
-    dataframe.
+    Given a psmpy object which has already done matching (or the matched_ids
+    frame from caliper_match) and the original dataframe on which the
+    matching was done, retrieve the relevant output dataframe.
     '''
     relevant_features = outcomes + [treatment]
 
-    matches = psmpy.matched_ids
+    matches = psmpy.matched_ids if isinstance(psmpy, PsmPy) else psmpy
     matches = matches.GISJOIN.tolist() + matches.matched_ID.tolist()
     matches = original_df.loc[original_df.GISJOIN.isin(matches), relevant_features]
 
     return matches
 
+def estimate_propensity_logit(data: pd.DataFrame, treatment: str, covariates: list[str],
+                              index: str='GISJOIN', seed: int=SEED) -> pd.Series:
+    '''
+    Fit the same logistic propensity model PsmPy does and return each unit's
+    propensity logit, indexed by index. Units missing covariates or the
+    treatment (e.g. a grade the treatment definition doesn't recode) are dropped.
+    '''
+    data = data.set_index(index)[covariates + [treatment]].dropna()
+    model = LogisticRegression(random_state=seed).fit(data[covariates], data[treatment])
+    return pd.Series(model.decision_function(data[covariates]), index=data.index,
+                     name='propensity_logit')
+
+def _nearest_candidates(values: np.ndarray, pool: np.ndarray,
+                        m: int) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    For each of values, the positions in the sorted array pool of its m
+    nearest entries and their distances, nearest first. The m nearest always
+    sit in the 2m entries around where the value would be inserted.
+    '''
+    m = min(m, len(pool))
+    window = np.searchsorted(pool, values)[:, None] + np.arange(-m, m)[None, :]
+    inside = (window >= 0) & (window < len(pool))
+    window = np.clip(window, 0, len(pool) - 1)
+    dist = np.where(inside, np.abs(pool[window] - values[:, None]), np.inf)
+
+    nearest = np.argsort(dist, axis=1, kind='stable')[:, :m]
+    return (np.take_along_axis(window, nearest, axis=1),
+            np.take_along_axis(dist, nearest, axis=1))
+
+def _find(parent: list[int], i: int) -> int:
+    '''
+    Root of i in a union-find parent list, compressing the path on the way.
+    '''
+    root = i
+    while parent[root] != root:
+        root = parent[root]
+    while parent[i] != root:
+        parent[i], i = root, parent[i]
+    return root
+
+def _greedy_pairs(treated: np.ndarray, pool: np.ndarray, caliper: float,
+                  k: int) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Greedy nearest available matching without replacement: of all the pairs
+    inside the caliper, the closest is always taken next, each control at
+    most once and each treated unit at most k times. Equally close pairs go
+    to the earlier treated unit first, then to the control on its left.
+    Which of several controls with the same logit gets used is arbitrary.
+
+    Every treated unit only keeps its nearest unused control on a heap.
+    Used controls are skipped over with union-find pointers to the next
+    unused control on either side, so a unit whose control was taken finds
+    its next one without rescanning the pool.
+    '''
+    n = len(pool)
+    values, pool = treated.tolist(), pool.tolist()
+    insert = np.searchsorted(np.asarray(pool), treated).tolist()
+
+    # The nearest unused control at or right of i is _find(right, i) (n if
+    # there's none), and at or left of i is _find(left, i + 1) - 1 (-1 if none)
+    right, left = list(range(n + 1)), list(range(n + 1))
+
+    def nearest(t):
+        r = _find(right, insert[t])
+        l = _find(left, insert[t]) - 1
+        d_r = pool[r] - values[t] if r < n else np.inf
+        d_l = values[t] - pool[l] if l >= 0 else np.inf
+        d, c = (d_l, l) if d_l <= d_r else (d_r, r)
+        return (d, t, c) if d <= caliper else None
+
+    heap = [pair for pair in map(nearest, range(len(values))) if pair is not None]
+    heapq.heapify(heap)
+    remaining = [k] * len(values)
+    pairs_t, pairs_c = [], []
+
+    while heap:
+        _, t, c = heapq.heappop(heap)
+        if right[c] == c:
+            right[c], left[c + 1] = c + 1, c
+            remaining[t] -= 1
+            pairs_t.append(t)
+            pairs_c.append(c)
+            if not remaining[t]:
+                continue
+
+        # Either c was taken by a closer pair, or t wants another control
+        pair = nearest(t)
+        if pair is not None:
+            heapq.heappush(heap, pair)
+
+    return np.array(pairs_t, dtype=int), np.array(pairs_c, dtype=int)
+
+def _optimal_pairs(treated: np.ndarray, pool: np.ndarray, caliper: float,
+                   k: int) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Optimal matching without replacement: minimize the total distance over
+    each treated unit's OPTIMAL_CANDIDATES * k nearest controls inside the
+    caliper. Every treated unit gets k slots and each slot a private "no
+    match" option, costlier than all the real pairs of any matching put
+    together, so a full matching always exists and the optimum has as many
+    real pairs as possible (the least total distance only breaks ties).
+
+    The assignment solver is far from linear in the number of slots, so
+    this is for city sized problems. Past OPTIMAL_WARN_SLOTS slots it warns,
+    and greedy matching is the better choice.
+    '''
+    n_slots = len(treated) * k
+    if n_slots > OPTIMAL_WARN_SLOTS:
+        warn(f"Optimal matching {n_slots} treated slots, this may take minutes. "
+             "method='greedy' scales to far larger problems.")
+    cand, dist = _nearest_candidates(treated, pool, OPTIMAL_CANDIDATES * k)
+    cand, dist = np.repeat(cand, k, axis=0), np.repeat(dist, k, axis=0)
+    slots = np.repeat(np.arange(n_slots), cand.shape[1])
+    close = dist.ravel() <= caliper
+
+    # Every slot uses exactly one edge, so shifting all costs up keeps the
+    # optimum while keeping zero distance edges from disappearing. Shifted
+    # real edges cost at most caliper + 1, so one more "no match" always
+    # costs more than whatever rearranging the real pairs saves
+    no_match = n_slots * (caliper + 1)
+    rows = np.concatenate([slots[close], np.arange(n_slots)])
+    cols = np.concatenate([cand.ravel()[close], len(pool) + np.arange(n_slots)])
+    costs = np.concatenate([dist.ravel()[close], np.full(n_slots, no_match)]) + 1
+
+    graph = csr_matrix((costs, (rows, cols)), shape=(n_slots, len(pool) + n_slots))
+    slot_idx, control_idx = min_weight_full_bipartite_matching(graph)
+    real = control_idx < len(pool)
+    return slot_idx[real] // k, control_idx[real]
+
+def caliper_match(logits: pd.Series, treated: pd.Series, caliper: float=CALIPER, k: int=1,
+                  replacement: bool=KNN_WITH_REPLACEMENT, method: str='greedy',
+                  index: str='GISJOIN') -> pd.DataFrame:
+    '''
+    Match treated units to k controls each on their propensity logits, using
+    sorted arrays instead of PsmPy's loop. Pairs further apart than caliper
+    standard deviations of the logit are never made.
+
+    Inputs:
+        logits: propensity logits, indexed by unit id
+        treated: 0/1 (or boolean) treatment, with the same index
+        replacement: whether controls can be reused; with replacement every
+            treated unit simply gets its k nearest controls
+        method: 'greedy' (closest pairs first) or 'optimal' (least total
+            distance, slow past OPTIMAL_WARN_SLOTS), only matters without
+            replacement
+
+    Returns:
+        The matched_ids frame, like PsmPy's: one row per pair, with the
+        treated unit in index and its control in matched_ID.
+    '''
+    if method not in MATCH_METHODS:
+        raise ValueError(f"Unknown method {method}, expected one of {MATCH_METHODS}")
+
+    is_treated = treated.reindex(logits.index).astype(bool).to_numpy()
+    treated_ids, control_ids = logits.index[is_treated], logits.index[~is_treated]
+    width = caliper * np.std(logits.to_numpy())
+
+    order = np.argsort(logits.to_numpy()[~is_treated], kind='stable')
+    pool = logits.to_numpy()[~is_treated][order]
+    values = logits.to_numpy()[is_treated]
+
+    if len(values) == 0 or len(pool) == 0:
+        t, c = np.array([], dtype=int), np.array([], dtype=int)
+    elif replacement:
+        cand, dist = _nearest_candidates(values, pool, k)
+        close = dist <= width
+        t, c = np.nonzero(close)[0], cand[close]
+    elif method == 'greedy':
+        t, c = _greedy_pairs(values, pool, width, k)
+    else:
+        t, c = _optimal_pairs(values, pool, width, k)
+
+    return pd.DataFrame({index: treated_ids[t], 'matched_ID': control_ids[order[c]]})
+
+def native_matched_ids(data: pd.DataFrame, treatment: str, covariates: list[str],
+                       caliper: float=CALIPER, k: int=1, replacement: bool=KNN_WITH_REPLACEMENT,
+                       method: str='greedy', index: str='GISJOIN', seed: int=SEED) -> pd.DataFrame:
+    '''
+    Propensity logits and caliper_match in one go, in place of make_psmpy,
+    logistic_ps and knn_matched. Pass the result to retrieve_matches.
+    '''
+    logits = estimate_propensity_logit(data, treatment, covariates, index, seed)
+    return caliper_match(logits, data.set_index(index)[treatment], caliper, k,
+                         replacement, method, index)
+
+def mom_alpha(y: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    '''
+    Method of moments negative binomial alpha, (var - mean) / mean^2, for
+    each row of frequency weights over the counts y. With weights of one
+    this is exactly the pandas mean / var estimate fit_models uses.
+    '''
+    n = weights.sum(axis=-1)
+    mean = (weights * y).sum(axis=-1) / n
+    var = (weights * (y - mean[..., None]) ** 2).sum(axis=-1) / (n - 1)
+    return (var - mean) / mean ** 2
+
+def nb_irls(y: np.ndarray, treatment: np.ndarray, weights: np.ndarray, offset: np.ndarray,
+            alpha: np.ndarray, max_iter: int=IRLS_MAX_ITER,
+            tol: float=IRLS_TOL) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Fit y ~ 1 + treatment negative binomial GLMs (log link, fixed alpha,
+    offset) for a whole batch of frequency weightings at once, by IRLS with
+    the 2x2 normal equations solved in closed form.
+
+    Inputs:
+        y, offset: (n,) or (batch, n) counts and offsets
+        treatment, weights: (n,) or (batch, n); weight 0 leaves a unit out
+        alpha: (batch,) dispersion of each fit
+    Returns:
+        (params, bse), each (batch, 2) for the intercept and treatment, with
+        statsmodels' GLM standard errors (scale fixed at 1). Fits that can't
+        be identified (e.g. no treated units) come out NaN.
+    '''
+    weights = np.atleast_2d(weights).astype(float)
+    treatment = np.broadcast_to(treatment, weights.shape).astype(float)
+    alpha = np.asarray(alpha, dtype=float)[:, None]
+
+    # Start where statsmodels does
+    mean_y = (weights * y).sum(axis=1, keepdims=True) / weights.sum(axis=1, keepdims=True)
+    eta = np.broadcast_to(np.log((y + mean_y) / 2), weights.shape)
+    params = np.zeros((len(weights), 2))
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        for _ in range(max_iter):
+            mu = np.exp(eta)
+            w = weights * mu / (1 + alpha * mu)
+            z = eta - offset + (y - mu) / mu
+
+            s0, s1, s11 = w.sum(axis=1), (w * treatment).sum(axis=1), (w * treatment ** 2).sum(axis=1)
+            b0, b1 = (w * z).sum(axis=1), (w * treatment * z).sum(axis=1)
+            det = s0 * s11 - s1 ** 2
+
+            new = np.column_stack([(s11 * b0 - s1 * b1) / det, (s0 * b1 - s1 * b0) / det])
+            converged = np.nanmax(np.abs(new - params), initial=0) < tol
+            params = new
+            eta = params[:, :1] + params[:, 1:] * treatment + offset
+            if converged:
+                break
+
+        mu = np.exp(eta)
+        w = weights * mu / (1 + alpha * mu)
+        s0, s1, s11 = w.sum(axis=1), (w * treatment).sum(axis=1), (w * treatment ** 2).sum(axis=1)
+        det = s0 * s11 - s1 ** 2
+        bse = np.sqrt(np.column_stack([s11 / det, s0 / det]))
+
+    return params, bse
+
+def nb_loglike(y: np.ndarray, mu: np.ndarray, alpha: np.ndarray,
+               weights: np.ndarray) -> np.ndarray:
+    '''
+    Weighted NB2 log likelihood of each row of a batch of fits.
+    '''
+    alpha = np.asarray(alpha, dtype=float)[:, None]
+    inv = 1 / alpha
+    ll = gammaln(y + inv) - gammaln(inv) - gammaln(y + 1) \
+        + y * np.log(alpha * mu / (1 + alpha * mu)) - inv * np.log1p(alpha * mu)
+    return np.where(weights > 0, weights * ll, 0).sum(axis=1)
+
+def ml_alpha(y: np.ndarray, treatment: np.ndarray, weights: np.ndarray, offset: np.ndarray,
+             bounds: tuple[float, float]=ML_LOG_ALPHA_BOUNDS,
+             n_iter: int=ML_ALPHA_ITER) -> np.ndarray:
+    '''
+    Maximum likelihood alpha of each fit in a batch, by a golden section
+    search on log alpha of the profile likelihood (the IRLS fit at each
+    alpha), run for the whole batch at once.
+    '''
+    def profile(log_alpha):
+        alpha = np.exp(log_alpha)
+        params = nb_irls(y, treatment, weights, offset, alpha)[0]
+        mu = np.exp(params[:, :1] + params[:, 1:] * treatment + offset)
+        return nb_loglike(y, mu, alpha, weights)
+
+    ratio = (np.sqrt(5) - 1) / 2
+    low, high = np.full(len(weights), bounds[0]), np.full(len(weights), bounds[1])
+    left, right = high - ratio * (high - low), low + ratio * (high - low)
+    f_left, f_right = profile(left), profile(right)
+
+    for _ in range(n_iter):
+        # Keep the side with the higher likelihood
+        go_left = f_left > f_right
+        high = np.where(go_left, right, high)
+        low = np.where(go_left, low, left)
+        new = np.where(go_left, high - ratio * (high - low), low + ratio * (high - low))
+        f_new = profile(new)
+
+        left, right, f_left, f_right = (
+            np.where(go_left, new, right), np.where(go_left, left, new),
+            np.where(go_left, f_new, f_right), np.where(go_left, f_left, f_new))
+
+    return np.exp((low + high) / 2)
+
+def long_format(matched: dict[str, pd.DataFrame], outcomes: dict[str, str]=OUTCOMES,
+                treatment: str='treatment_') -> pd.DataFrame:
+    '''
+    Stack matched frames ({city: matched_df}) into one long frame with a
+    row per city, outcome and tract: city, outcome, treatment, log_exposure
+    and count. Missing counts are dropped, as the formula models drop them.
+    '''
+    frames = [pd.DataFrame({
+        'city': city,
+        'outcome': name,
+        'treatment': df[treatment].to_numpy(dtype=float),
+        'log_exposure': df['log_exposure'].to_numpy(dtype=float),
+        'count': df[column].to_numpy(dtype=float),
+    }) for city, df in matched.items() for name, column in outcomes.items()]
+    return pd.concat(frames, ignore_index=True).dropna(subset=['count'])
+
+def fit_nb_batch(long_df: pd.DataFrame, alpha_method: str='mom',
+                 group_columns: list[str]=['city', 'outcome']) -> pd.DataFrame:
+    '''
+    Fit count ~ 1 + treatment negative binomial GLMs (offset log_exposure)
+    for every group of a long_format frame in one batched IRLS, with each
+    group padded out to the largest one with zero weights.
+
+    alpha is estimated per group, by method of moments ('mom', what
+    fit_models does, giving the same numbers as statsmodels' GLM) or by
+    maximum likelihood ('ml'). Standard errors are the GLM ones at that
+    alpha, and p-values are two sided normal ones, as statsmodels reports.
+
+    Returns one row per group: its group columns, coef, se, z, p,
+    intercept, alpha and n.
+    '''
+    if alpha_method not in ['mom', 'ml']:
+        raise ValueError(f"Unknown alpha_method {alpha_method}, expected 'mom' or 'ml'")
+
+    groups = long_df.groupby(group_columns, sort=False)
+    group_idx, position = groups.ngroup().to_numpy(), groups.cumcount().to_numpy()
+    shape = (group_idx.max() + 1, position.max() + 1)
+
+    def padded(column):
+        values = np.zeros(shape)
+        values[group_idx, position] = long_df[column].to_numpy(dtype=float)
+        return values
+
+    y, treatment, offset = padded('count'), padded('treatment'), padded('log_exposure')
+    weights = np.zeros(shape)
+    weights[group_idx, position] = 1
+
+    alpha = mom_alpha(y, weights) if alpha_method == 'mom' else \
+        ml_alpha(y, treatment, weights, offset)
+    params, bse = nb_irls(y, treatment, weights, offset, alpha)
+
+    fits = groups.size().rename('n').reset_index()
+    fits['coef'], fits['se'] = params[:, 1], bse[:, 1]
+    fits['z'] = fits.coef / fits.se
+    fits['p'] = 2 * norm.sf(np.abs(fits.z))
+    fits['intercept'], fits['alpha'] = params[:, 0], alpha
+    return fits[[*group_columns, 'coef', 'se', 'z', 'p', 'intercept', 'alpha', 'n']]
+
+def results_table(fits: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Reshape fit_nb_batch's city x outcome fits into the results_<definition>.csv
+    format, one row per city.
+    '''
+    wide = fits.pivot(index='city', columns='outcome', values=['coef', 'se', 'p'])
+    wide.columns = [f'{outcome}_{stat}' for stat, outcome in wide.columns]
+    wide = wide.reindex(fits.city.unique()).reset_index()
+    return wide[RESULT_COLUMNS]
+
+def compare_with_statsmodels(long_df: pd.DataFrame, fits: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Refit every group of a fit_nb_batch run with statsmodels' GLM at the
+    same alpha and return the absolute differences in coef, se and p, to
+    check the batched solver against.
+    '''
+    rows = []
+    for fit in fits.itertuples(index=False):
+        group = long_df[(long_df.city == fit.city) & (long_df.outcome == fit.outcome)]
+        result = smf.glm('count ~ treatment', data=group,
+                         family=sm.families.NegativeBinomial(alpha=fit.alpha),
+                         offset=group['log_exposure']).fit()
+        rows.append({'city': fit.city, 'outcome': fit.outcome,
+                     'coef': abs(result.params['treatment'] - fit.coef),
+                     'se': abs(result.bse['treatment'] - fit.se),
+                     'p': abs(result.pvalues['treatment'] - fit.p)})
+    return pd.DataFrame(rows)
+
+def _replicate_matches(data: pd.DataFrame, treatment: str, covariates: list[str], kind: str,
+                       n_reps: int, seed: np.random.SeedSequence, caliper: float, k: int,
+                       replacement: bool, method: str) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Redo propensity estimation and matching n_reps times on resampled data.
+    Returns (treatment, weights), each (n_reps, n): the treatment every unit
+    had in that replicate, and how many times it counts in the outcome fit
+    (its bootstrap count if it was matched, 0 if not).
+    '''
+    rng = np.random.default_rng(seed)
+    X, t = data[covariates].to_numpy(), data[treatment].to_numpy().astype(int)
+    n = len(data)
+    treatments, weights = np.empty((n_reps, n)), np.zeros((n_reps, n))
+
+    for rep in range(n_reps):
+        if kind == 'bootstrap':
+            counts, rep_t = rng.multinomial(n, np.full(n, 1 / n)), t
+        else:
+            counts, rep_t = np.ones(n, dtype=int), rng.permutation(t)
+
+        keep = np.flatnonzero(counts)
+        if len(np.unique(rep_t[keep])) < 2:
+            weights[rep] = np.nan
+            treatments[rep] = rep_t
+            continue
+
+        model = LogisticRegression(random_state=SEED)
+        model.fit(X[keep], rep_t[keep], sample_weight=counts[keep])
+        logits = pd.Series(model.decision_function(X[keep]), index=keep)
+        pairs = caliper_match(logits, pd.Series(rep_t[keep], index=keep), caliper, k,
+                              replacement, method, index='unit')
+
+        matched = np.unique(pairs.to_numpy().ravel()).astype(int)
+        weights[rep, matched] = counts[matched]
+        treatments[rep] = rep_t
+
+    return treatments, weights
+
+def _replicate_task(args: tuple) -> tuple[np.ndarray, np.ndarray]:
+    return _replicate_matches(*args)
+
+def resample_inference(city_data: pd.DataFrame, covariates: list[str], observed: dict,
+                       n_boot: int=1000, n_perm: int=0, treatment: str='treatment_',
+                       caliper: float=CALIPER, k: int=1, replacement: bool=True,
+                       method: str='greedy', seed: int=SEED, n_workers: int=1) -> dict:
+    '''
+    Bootstrap and/or permutation inference for match-then-fit, so the
+    uncertainty of the matching step is counted too. Every replicate redoes
+    the propensity model and the matching (with caliper_match), then all the
+    replicates' negative binomial fits run as one batch with nb_irls, with
+    alpha re-estimated by method of moments in each.
+
+    Bootstrap replicates draw tracts with replacement, used as frequency
+    weights. Permutation replicates shuffle the treatment. As in the formula
+    models, tracts with a missing count are left out of that outcome's fit,
+    and as in feature_selection, tracts missing a covariate or the treatment
+    are left out entirely. Replicates run in chunks of REPLICATE_CHUNK with their own seeds, spread
+    over n_workers processes, so results don't depend on n_workers.
+
+    Inputs:
+        observed: the city's results row, for the permutation p-values
+    Returns:
+        {outcome}_ci_low / {outcome}_ci_high (95% percentile interval of the
+        coefficient) and {outcome}_perm_p, for each outcome in OUTCOMES.
+    '''
+    data = city_data.dropna(subset=covariates + [treatment]).reset_index(drop=True)
+    offset = np.full(len(data), np.log(5))
+
+    jobs = []
+    for kind_idx, (kind, n_reps) in enumerate([('bootstrap', n_boot), ('permutation', n_perm)]):
+        sizes = [min(REPLICATE_CHUNK, n_reps - i) for i in range(0, n_reps, REPLICATE_CHUNK)]
+        seeds = np.random.SeedSequence([seed, kind_idx]).spawn(len(sizes))
+        jobs += [(kind, (data, treatment, covariates, kind, size, chunk_seed, caliper, k,
+                         replacement, method)) for size, chunk_seed in zip(sizes, seeds)]
+
+    if n_workers > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            outputs = list(pool.map(_replicate_task, [args for _, args in jobs]))
+    else:
+        outputs = [_replicate_task(args) for _, args in jobs]
+
+    inference = {}
+    for kind in ['bootstrap', 'permutation']:
+        chunks = [out for (job_kind, _), out in zip(jobs, outputs) if job_kind == kind]
+        if not chunks:
+            continue
+        treatments = np.concatenate([t for t, _ in chunks])
+        weights = np.concatenate([w for _, w in chunks])
+
+        for name, column in OUTCOMES.items():
+            y = data[column].to_numpy(dtype=float)
+            rep_weights = np.where(np.isnan(y), 0, weights)
+            y = np.nan_to_num(y)
+
+            alpha = mom_alpha(y, rep_weights)
+            coefs = nb_irls(y, treatments, rep_weights, offset, alpha)[0][:, 1]
+            coefs = coefs[np.isfinite(coefs)]
+
+            if kind == 'bootstrap':
+                inference[f'{name}_ci_low'], inference[f'{name}_ci_high'] = \
+                    np.percentile(coefs, [2.5, 97.5]) if len(coefs) else (np.nan, np.nan)
+            else:
+                extreme = np.sum(np.abs(coefs) >= abs(observed[f'{name}_coef']))
+                inference[f'{name}_perm_p'] = (1 + extreme) / (1 + len(coefs))
+
+    return inference
+
+def results_row(results_crash, results_311, city: str, treatment: str='treatment_') -> dict:
+    '''
+    Pull the treatment effect out of fitted crash and 311 models as one row
+    of the results table.
+    '''
+    return {
+        'city': city,
+        '311_coef': results_311.params[treatment],
+        '311_se': results_311.bse[treatment],
+        '311_p': results_311.pvalues[treatment],
+        'crash_coef': results_crash.params[treatment],
+        'crash_se': results_crash.bse[treatment],
+        'crash_p': results_crash.pvalues[treatment],
+    }
+
 def update_results(running_results: dict[list[str]], results_crash, results_311, city: str,
                    treatment: str='treatment_'):
     '''
     Update the running results dictionary with new values
     '''
-    running_results['city'].append(city)
-    running_results['311_coef'].append(results_311.params[treatment])
-    running_results['311_se'].append(results_311.bse[treatment])
-    running_results['311_p'].append(results_311.pvalues[treatment])
-    running_results['crash_coef'].append(results_crash.params[treatment])
-    running_results['crash_se'].append(results_crash.bse[treatment])
-    running_results['crash_p'].append(results_crash.pvalues[treatment])
+    for column, value in results_row(results_crash, results_311, city, treatment).items():
+        running_results[column].append(value)
 
-def run_models_update_results(matched_df: pd.DataFrame, all_results: dict[list[str]], city: str,
-                              treatment: str="treatment_"):
+def fit_models(matched_df: pd.DataFrame, treatment: str="treatment_", verbose: bool=True):
     '''
-    Run actual models + update the results dict
+    Fit the negative binomial crash and 311 models on matched data, and
+    return (crash results, 311 results).
     '''
-
     mean_crashes = matched_df.n_crashes.mean()
     var_crashes = matched_df.n_crashes.var()
     alpha_crashes_est = (var_crashes - mean_crashes) / (mean_crashes ** 2)
 
-    print(f"Estimating an alpha of {alpha_crashes_est} for crashes")
+    if verbose: print(f"Estimating an alpha of {alpha_crashes_est} for crashes")
     crash_model = smf.glm(
         formula=f'n_crashes ~ {treatment}',
         data=matched_df,
@@ -150,7 +721,7 @@ def run_models_update_results(matched_df: pd.DataFrame, all_results: dict[list[s
         offset=matched_df['log_exposure']
     )
 
-    print(f"""Checking Asumptions of Negative Binomial Model for 311s:
+    if verbose: print(f"""Checking Asumptions of Negative Binomial Model for 311s:
     \tMean 311s: {matched_df.n_311s.mean()}
     \tVariance of 311s: {matched_df.n_311s.var()}
     """)
@@ -158,7 +729,7 @@ def run_models_update_results(matched_df: pd.DataFrame, all_results: dict[list[s
     var_311 = matched_df.n_311s.var()
     alpha_311s_est = (var_311 - mean_311) / (mean_311 ** 2)
 
-    print(f"Estimating an alpha of {alpha_311s_est} for 311s")
+    if verbose: print(f"Estimating an alpha of {alpha_311s_est} for 311s")
     threeoneone_model = smf.glm(
         formula=f'n_311s ~ {treatment}',
         data=matched_df,
@@ -169,28 +740,171 @@ def run_models_update_results(matched_df: pd.DataFrame, all_results: dict[list[s
     results_crash = crash_model.fit()
     results_311 = threeoneone_model.fit()
 
-    print(results_crash.summary())
-    print(results_311.summary())
+    if verbose:
+        print(results_crash.summary())
+        print(results_311.summary())
 
+    return results_crash, results_311
+
+def run_models_update_results(matched_df: pd.DataFrame, all_results: dict[list[str]], city: str,
+                              treatment: str="treatment_", verbose: bool=True):
+    '''
+    Run actual models + update the results dict
+    '''
+    results_crash, results_311 = fit_models(matched_df, treatment, verbose)
     update_results(all_results, results_crash, results_311, city)
 
+@lru_cache(maxsize=None)
+def city_boundary(city_name: str, crs: str) -> gpd.GeoDataFrame:
+    '''
+    Geocode a city's modern administrative boundary and project it to crs.
+    Kept on disk in BOUNDARY_CACHE and in memory, so each city is only ever
+    geocoded and projected once.
+    '''
+    crs_tag = hashlib.sha256(crs.encode()).hexdigest()[:12]
+    path = os.path.join(BOUNDARY_CACHE, f"{city_name.replace(' ', '_').replace(',', '')}_{crs_tag}.gpkg")
+    if os.path.exists(path):
+        return gpd.read_file(path)
+
+    city = ox.geocode_to_gdf(city_name).to_crs(crs)[['geometry']]
+    os.makedirs(BOUNDARY_CACHE, exist_ok=True)
+    city.to_file(path)
+    return city
 
 def enforce_administrative_boundaries(city_data: gpd.geodataframe, city_name: str) -> gpd.GeoDataFrame:
     '''
     Given a geodataframe containing the data for a given city and the name of the city,
     ensure that we are only using tracts within the city's modern administrative bounds.
     '''
-    city = ox.geocode_to_gdf(city_name)
-    city = city.to_crs(city_data.crs)
-    
-    # GeoPandas intersection is a 1 to 1 operation with no brodcasting
-    repeated_city = [city[['geometry']] for i in range(city_data.shape[0])]
-    city = pd.concat(repeated_city, axis=0)
+    city = city_boundary(city_name, city_data.crs.to_string())
 
-    # Mask and return
-    mask = city_data.intersects(city, align=False)
+    # Intersecting with the one boundary polygon broadcasts over every tract
+    mask = city_data.intersects(city.geometry.iloc[0])
     return city_data[mask]
 
+def prepare_treatment(df: pd.DataFrame, definition: str) -> pd.DataFrame:
+    '''
+    Recode census_final_fixed into a 0/1 treatment_ column under one of
+    TREATMENT_DEFINITIONS, dropping the columns it was made from.
+    '''
+    column, mapper = TREATMENT_DEFINITIONS[definition]
+    df_rel = df.copy()
+    df_rel['treatment_'] = df_rel[column].map(mapper)
+    return df_rel.drop(columns=['grade', 'nyn'])
+
+def check_resampling(native: bool, n_boot: int, n_perm: int) -> None:
+    '''
+    Raise a ValueError if resampling was asked for without the native matcher.
+    '''
+    if (n_boot or n_perm) and not native:
+        raise ValueError('n_boot and n_perm rematch with caliper_match, so they '
+                         'need native=True to agree with the point estimates.')
+
+def match_city(city_data: pd.DataFrame, city: str, seed: int=SEED, replacement: bool=True,
+               caliper: float=CALIPER, treatment: str='treatment_',
+               native: bool=False, method: str='greedy', k: int=1,
+               n_boot: int=0, n_perm: int=0, n_workers: int=1) -> tuple[dict, list[str]]:
+    '''
+    Everything the result notebooks do for one city: pick covariates, fit
+    propensity scores, match, and model the matched tracts. Everything random
+    is seeded from seed, so the same inputs always give the same row. With
+    native, matching is done by caliper_match (with method and k) instead of
+    PsmPy. With n_boot or n_perm, the row also gets resample_inference's
+    bootstrap intervals and permutation p-values, computed over n_workers
+    processes. Those replicates always rematch with caliper_match, so they
+    need native, or they would describe a different estimator than the row's.
+
+    Returns (results row, covariates matched on).
+    '''
+    check_resampling(native, n_boot, n_perm)
+    np.random.seed(seed)
+
+    covariates = feature_selection(city_data)
+    if native:
+        matches = native_matched_ids(city_data, treatment, covariates, caliper, k,
+                                     replacement, method, seed=seed)
+    else:
+        matches = make_psmpy(city_data[covariates + ['n_crashes', treatment, 'GISJOIN']],
+                             treatment=treatment, outcome='n_crashes', seed=seed)
+        matches.logistic_ps(balance=PROP_BALANCE)
+        matches.knn_matched(matcher=PROP_MATCHER, replacement=replacement, caliper=caliper,
+                            drop_unmatched=DROP_UNMATCHED)
+
+    matched = retrieve_matches(matches, city_data, treatment=treatment)
+    matched['log_exposure'] = np.log(5)
+
+    fits = fit_nb_batch(long_format({city: matched}, treatment=treatment))
+    row = results_table(fits).iloc[0].to_dict()
+    if n_boot or n_perm:
+        row.update(resample_inference(city_data, covariates, row, n_boot, n_perm, treatment,
+                                      caliper, k, replacement, method, seed, n_workers))
+    return row, covariates
+
+def _match_task(args: tuple) -> tuple[dict, list[str]]:
+    return match_city(*args)
+
+def run_matching_grid(df: pd.DataFrame, definitions: list[str]=list(TREATMENT_DEFINITIONS),
+                      n_workers: int=None, seed: int=SEED, replacement: bool=True,
+                      save_loc: str='../../data/outcomes', native: bool=False,
+                      method: str='greedy', n_boot: int=0, n_perm: int=0,
+                      resample_workers: int=1) -> dict[str, pd.DataFrame]:
+    '''
+    Run match_city for every city x treatment definition as its own task in
+    a process pool, so the whole grid takes about as long as its slowest
+    city. Boundaries are enforced up front, since they're shared.
+
+    Returns {definition: results}, with results in the results_<definition>.csv
+    format, which (along with covariates_<definition>.csv) is also written to
+    save_loc unless it's None. replacement defaults to True, as in the
+    result notebooks. native, method, n_boot and n_perm are passed on to
+    match_city (n_boot and n_perm need native), and resample_workers as its
+    n_workers, so each task's replicates get a pool of their own on top of
+    the grid's n_workers; bootstrap intervals land in the
+    {outcome}_ci_low/high columns plot_estimates picks up.
+    '''
+    check_resampling(native, n_boot, n_perm)
+    cities = {name: enforce_administrative_boundaries(df[df.STATE == state], query)
+              for name, _, state, query in CITY_SPECS}
+    covariate_names = {name: covariate_name for name, covariate_name, _, _ in CITY_SPECS}
+
+    tasks = [(definition, name) for definition in definitions for name in cities]
+    args = [(prepare_treatment(cities[name], definition), name, seed, replacement,
+             CALIPER, 'treatment_', native, method, 1, n_boot, n_perm, resample_workers)
+            for definition, name in tasks]
+
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        outputs = dict(zip(tasks, pool.map(_match_task, args)))
+
+    all_results = {}
+    for definition in definitions:
+        rows = [outputs[(definition, name)][0] for name in cities]
+        extra = [col for col in rows[0] if col not in RESULT_COLUMNS]
+        results = pd.DataFrame(rows, columns=RESULT_COLUMNS + extra)
+        covariates = pd.DataFrame({covariate_names[name]: outputs[(definition, name)][1]
+                                   for name in cities})
+
+        if save_loc is not None:
+            results.to_csv(f'{save_loc}/results_{definition}.csv')
+            covariates.to_csv(f'{save_loc}/covariates_{definition}.csv')
+        all_results[definition] = results
+
+    return all_results
+
+def irr_bounds(results: pd.DataFrame, value_to_plot: str) -> tuple[pd.Series, pd.Series]:
+    '''
+    95% bounds of the IRR: the bootstrap interval where the results have
+    one, and coef +/- 1.96 standard errors otherwise.
+    '''
+    se = f"{value_to_plot}_se"
+    coef = f"{value_to_plot}_coef"
+    low, high = results[coef] - 1.96 * results[se], results[coef] + 1.96 * results[se]
+
+    if f"{value_to_plot}_ci_low" in results.columns:
+        low = results[f"{value_to_plot}_ci_low"].fillna(low)
+        high = results[f"{value_to_plot}_ci_high"].fillna(high)
+
+    return np.exp(low), np.exp(high)
+
 def plot_estimates(results: pd.DataFrame, value_to_plot: str,
                    ylabel: str, title: str):
     # Figure out what to plot
@@ -200,7 +914,7 @@ def plot_estimates(results: pd.DataFrame, value_to_plot: str,
     fig, ax = plt.subplots(figsize=(12, 7.5))
 
     # Get IRRs
-    lower_bound, upper_bound = np.exp(results[coef] - 1.96 * results[se]), np.exp(results[coef] + 1.96 * results[se]) 
+    lower_bound, upper_bound = irr_bounds(results, value_to_plot)
     irr = np.exp(results[coef])
     yerr = [irr - lower_bound, upper_bound - irr]
     
@@ -258,7 +972,7 @@ def plot_both_estimates(results: pd.DataFrame, value_to_plot_1: str, value_to_pl
         coef = f"{value_to_plot}_coef"
 
         # Calculate IRRs and confidence intervals
-        lower_bound, upper_bound = np.exp(results[coef] - 1.96 * results[se]), np.exp(results[coef] + 1.96 * results[se])
+        lower_bound, upper_bound = irr_bounds(results, value_to_plot)
         irr = np.exp(results[coef])
 
         # Plot error bars with shifted x positions
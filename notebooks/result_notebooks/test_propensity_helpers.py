@@ -0,0 +1,59 @@
+### About: Checks the batched negative binomial fits against statsmodels on a
+### synthetic panel. Run from the result_notebooks folder with pytest.
+
+import numpy as np
+import pandas as pd
+import pytest
+import statsmodels.api as sm
+
+import propensity_helpers as ph
+
+# Cities of different sizes, so groups get padded, with their own effects
+CITY_SIZES = {'Chicago': 300, 'Detroit': 180, 'Los Angeles': 240}
+TOL = 1e-6
+
+@pytest.fixture(scope='module')
+def panel() -> pd.DataFrame:
+    '''
+    A long_format frame of NB2 counts, with a few counts missing.
+    '''
+    rng = np.random.default_rng(0)
+    matched = {}
+    for i, (city, n) in enumerate(CITY_SIZES.items()):
+        df = pd.DataFrame({'treatment_': (rng.random(n) < 0.5).astype(int),
+                           'log_exposure': np.log(5)})
+        for j, column in enumerate(ph.OUTCOMES.values()):
+            mu = np.exp(1 + 0.2 * (i - j) * df.treatment_ + df.log_exposure)
+            alpha = 0.3 + 0.2 * i
+            counts = rng.negative_binomial(1 / alpha, 1 / (1 + alpha * mu)).astype(float)
+            counts[rng.random(n) < 0.05] = np.nan
+            df[column] = counts
+        matched[city] = df
+    return ph.long_format(matched)
+
+def test_mom_fits_match_statsmodels(panel):
+    fits = ph.fit_nb_batch(panel)
+    assert len(fits) == len(CITY_SIZES) * len(ph.OUTCOMES)
+
+    diffs = ph.compare_with_statsmodels(panel, fits)
+    assert (diffs[['coef', 'se', 'p']] < TOL).all().all()
+
+    # The same alpha fit_models estimates from the pandas mean and variance
+    for fit in fits.itertuples(index=False):
+        counts = panel[(panel.city == fit.city) & (panel.outcome == fit.outcome)]['count']
+        mean, var = counts.mean(), counts.var()
+        assert fit.alpha == pytest.approx((var - mean) / mean ** 2, rel=TOL)
+        assert fit.n == len(counts)
+
+def test_ml_fits_match_statsmodels(panel):
+    fits = ph.fit_nb_batch(panel, alpha_method='ml')
+    diffs = ph.compare_with_statsmodels(panel, fits)
+    assert (diffs[['coef', 'se', 'p']] < TOL).all().all()
+
+    # The alpha statsmodels' maximum likelihood NB2 model finds
+    for fit in fits.itertuples(index=False):
+        group = panel[(panel.city == fit.city) & (panel.outcome == fit.outcome)]
+        result = sm.NegativeBinomial(group['count'], sm.add_constant(group['treatment']),
+                                     offset=group['log_exposure']).fit(disp=0)
+        assert fit.alpha == pytest.approx(result.params['alpha'], rel=1e-4)
+        assert fit.coef == pytest.approx(result.params['treatment'], abs=TOL)
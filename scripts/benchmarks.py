@@ -0,0 +1,346 @@
+### About: Timing comparisons between the old and new versions of our
+### hot spots. Run from the scripts folder, e.g. python benchmarks.py
+
+import os
+import sys
+import tempfile
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+import geopandas as gpd
+import shapely
+
+import city_helpers as ch
+import storage_helpers as stg
+import treatment_helpers as th
+import spatial_helpers as sh
+
+PAGE_SIZE = 50000
+
+# How much faster dms_to_decimal has to be than to_decimal row by row
+MIN_DMS_SPEEDUP = 3
+
+def timed(f, *args, **kwargs) -> float:
+    '''
+    Return how many seconds a call to f takes.
+    '''
+    start = perf_counter()
+    f(*args, **kwargs)
+    return perf_counter() - start
+
+def fake_pages(n_rows: int, page_size: int = PAGE_SIZE) -> list[pd.DataFrame]:
+    '''
+    Make n_rows of fake SODA output split into pages of page_size rows.
+    '''
+    rng = np.random.default_rng(42)
+    df = pd.DataFrame({
+        'unique_key': np.arange(n_rows).astype(str),
+        'complaint_type': rng.choice(['Street Light Condition', 'Noise', 'Graffiti'], n_rows),
+        'latitude': rng.uniform(40.5, 40.9, n_rows).astype(str),
+        'longitude': rng.uniform(-74.2, -73.7, n_rows).astype(str),
+    })
+    return [df[i:i + page_size] for i in range(0, n_rows, page_size)]
+
+def old_accumulate(pages: list[pd.DataFrame]) -> pd.DataFrame:
+    '''
+    The concat + drop_duplicates loop the fetchers used to run.
+    '''
+    df = pages[0].copy()
+    for page in pages[1:]:
+        df = pd.concat([df, page], ignore_index=True).drop_duplicates()
+    return df
+
+def new_accumulate(pages: list[pd.DataFrame], key: str = 'unique_key') -> pd.DataFrame:
+    '''
+    The same pages through ch.PageAccumulator.
+    '''
+    acc = ch.PageAccumulator(key)
+    for page in pages:
+        acc.add(page)
+    return acc.to_frame()
+
+def bench_accumulators(sizes=(100000, 200000, 400000, 800000)):
+    print('Page accumulation (seconds):')
+    print(f"{'rows':>10} {'concat':>10} {'accumulator':>12}")
+    for n in sizes:
+        pages = fake_pages(n)
+        old, new = timed(old_accumulate, pages), timed(new_accumulate, pages)
+        print(f"{n:>10} {old:>10.3f} {new:>12.3f}")
+
+def old_filter_text_col(df: pd.DataFrame, col: str, relevant_terms: list[str]) -> pd.DataFrame:
+    '''
+    The per row filter_text_col we used to have.
+    '''
+    def is_relevant(s):
+        for val in relevant_terms:
+            if val in str(s).lower():
+                return True
+        return False
+
+    return df[df[col].apply(lambda x: is_relevant(x))]
+
+def bench_filter_text_col(n_rows: int = 10_000_000):
+    rng = np.random.default_rng(42)
+    request_types = np.array(['Street Light Condition', 'Noise - Residential', 'Graffiti',
+                              'Illegal Dumping', 'HEAT/HOT WATER', 'Blocked Driveway',
+                              'Streetlight Out', None], dtype=object)
+    df = pd.DataFrame({'complaint_type': rng.choice(request_types, n_rows)})
+    terms = ['streetlight', 'street light', 'dumping', 'graffiti']
+
+    start = perf_counter()
+    old = old_filter_text_col(df, 'complaint_type', terms)
+    old_time = perf_counter() - start
+
+    start = perf_counter()
+    new = ch.filter_text_col(df, 'complaint_type', terms)
+    new_time = perf_counter() - start
+
+    assert old.index.equals(new.index), 'filter_text_col no longer matches the old version!'
+    print(f'filter_text_col on {n_rows} rows: old {old_time:.2f}s, new {new_time:.2f}s')
+    print(ch.count_terms(df, 'complaint_type', terms))
+
+def fake_arcgis_payload(n_features: int = 50000) -> dict:
+    '''
+    Make a fake ArcGIS query response with n_features crash records.
+    '''
+    rng = np.random.default_rng(42)
+    return {'features': [
+        {'attributes': {'crash_id': i, 'year': int(rng.integers(2018, 2023)),
+                        'latitude': float(rng.uniform(42.3, 42.45)),
+                        'longitude': float(rng.uniform(-83.2, -82.9))}}
+        for i in range(n_features)
+    ]}
+
+def old_arcgis_page_frame(payload: dict, rel_columns: list) -> pd.DataFrame:
+    '''
+    How request_all_arcgis used to build each page: one dataframe per feature.
+    '''
+    next_chunk = [pd.DataFrame(payload['features'][i]['attributes'], index=[i])
+                  for i in range(len(list(payload['features'])))]
+    return pd.concat(next_chunk, ignore_index=True)[rel_columns]
+
+def bench_arcgis_pages(n_features: int = 50000):
+    payload = fake_arcgis_payload(n_features)
+    columns = ['crash_id', 'year', 'latitude', 'longitude']
+
+    old = timed(old_arcgis_page_frame, payload, columns)
+    new = timed(ch.arcgis_page_frame, payload, columns)
+    assert old_arcgis_page_frame(payload, columns).equals(ch.arcgis_page_frame(payload, columns))
+    print(f'ArcGIS page of {n_features} features: old {old:.2f}s, new {new:.3f}s')
+
+def bench_dms(n_rows: int = 1_000_000):
+    rng = np.random.default_rng(42)
+    degrees = rng.integers(74, 76, n_rows)
+    minutes = rng.integers(0, 60, n_rows)
+    seconds = rng.uniform(0, 60, n_rows).round(4)
+    dms = pd.Series([f'{d} {m}:{s}' for d, m, s in zip(degrees, minutes, seconds)])
+
+    old = timed(lambda: dms.apply(ch.to_decimal).apply(lambda x: -x))
+    new = timed(lambda: -ch.dms_to_decimal(dms))
+    assert dms.apply(ch.to_decimal).equals(ch.dms_to_decimal(dms))
+    print(f'DMS parsing of {n_rows} rows: old {old:.2f}s, new {new:.2f}s')
+    assert new * MIN_DMS_SPEEDUP < old, f'dms_to_decimal is only {old / new:.1f}x faster'
+
+def disk_size(path: str) -> int:
+    '''
+    Bytes taken up by a file, or by everything under a folder.
+    '''
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(root, f))
+               for root, _, files in os.walk(path) for f in files)
+
+def fake_points(n_rows: int) -> pd.DataFrame:
+    '''
+    Make n_rows of fake cleaned 311 output.
+    '''
+    rng = np.random.default_rng(42)
+    return pd.DataFrame({
+        'ID': np.char.add('NY', np.arange(n_rows).astype(str)),
+        'city': rng.choice(['Los Angeles', 'Chicago', 'NYC', 'Detroit', 'Philadelphia'], n_rows),
+        'year': rng.integers(2018, 2023, n_rows),
+        'latitude': rng.uniform(40.5, 40.9, n_rows),
+        'longitude': rng.uniform(-74.2, -73.7, n_rows),
+        'request_type': rng.choice(['Street Light Condition', 'Graffiti', 'Illegal Dumping'], n_rows),
+    })
+
+def bench_storage(n_rows: int = 1_000_000, n_shp_rows: int = 200_000):
+    df = fake_points(n_rows)
+    points = gpd.GeoDataFrame(df[:n_shp_rows], crs='EPSG:4326',
+                              geometry=gpd.points_from_xy(df.longitude[:n_shp_rows],
+                                                          df.latitude[:n_shp_rows]))
+
+    print('Storage (seconds, MB):')
+    print(f"{'format':>24} {'rows':>9} {'write':>7} {'read':>7} {'read 2 cols':>12} {'size':>7}")
+    with tempfile.TemporaryDirectory() as tmp:
+        csv, parquet = f'{tmp}/points.csv', f'{tmp}/points.parquet'
+        # Shapefiles are several files, so give them a folder to measure
+        os.makedirs(f'{tmp}/shp')
+        shp, geoparquet = f'{tmp}/shp/points.shp', f'{tmp}/points_geo.parquet'
+        cases = [
+            ('csv', n_rows, csv, lambda: df.to_csv(csv),
+             lambda: pd.read_csv(csv),
+             lambda: pd.read_csv(csv, usecols=['latitude', 'longitude'])),
+            ('parquet (by city)', n_rows, parquet, lambda: stg.write_points(df, parquet),
+             lambda: stg.read_points(parquet),
+             lambda: stg.read_points(parquet, columns=['latitude', 'longitude'])),
+            ('shapefile', n_shp_rows, f'{tmp}/shp', lambda: points.to_file(shp),
+             lambda: gpd.read_file(shp),
+             lambda: gpd.read_file(shp, columns=['year'])),
+            ('geoparquet', n_shp_rows, geoparquet, lambda: stg.write_tracts(points, geoparquet),
+             lambda: stg.read_tracts(geoparquet),
+             lambda: stg.read_tracts(geoparquet, columns=['year'])),
+        ]
+        for name, rows, path, write, read, read_cols in cases:
+            write_time = timed(write)
+            read_time, cols_time = timed(read), timed(read_cols)
+            print(f"{name:>24} {rows:>9} {write_time:>7.2f} {read_time:>7.2f} "
+                  f"{cols_time:>12.2f} {disk_size(path) / 1e6:>7.1f}")
+
+def old_valid_response(nyn):
+    '''
+    fix_final_data.valid_response as it used to be, one row at a time.
+    '''
+    for yes in th.YES_LST:
+        if yes in (str(nyn)).lower():
+            return True
+
+    for no in th.NO_LST:
+        if no in (str(nyn)).lower():
+            return False
+
+    return False
+
+def old_patchwork_fixes(all_field):
+    '''
+    fix_final_data.patchwork_fixes as it used to be, one row at a time.
+    '''
+    if 'no negro' in all_field.lower():
+        return False
+
+    if 'no infiltration' in all_field.lower():
+        return False
+
+    if 'negro' in all_field.lower():
+        return True
+
+    return False
+
+def old_tract_treatment(overlay: pd.DataFrame) -> pd.DataFrame:
+    '''
+    The row by row labelling fix_final_data.py used to do.
+    '''
+    overlay = overlay.copy()
+    overlay['nyn'] = overlay.negro_yes_or_no.apply(old_valid_response)
+    overlay['nyn'] = overlay.nyn | overlay.all_fields.apply(old_patchwork_fixes)
+
+    overlay['nyn'] = overlay.groupby('GISJOIN')['nyn'].transform(lambda x: any(x))
+    return overlay[['GISJOIN', 'nyn']].drop_duplicates()
+
+def old_treatment_labels(grades: pd.Series, nyns: pd.Series) -> list[str]:
+    treatment_labels = []
+
+    for grade, nyn in zip(grades, nyns):
+        lbl = '_black' if nyn else ''
+        treatment_labels.append(f"{grade}{lbl}")
+
+    return treatment_labels
+
+def fake_overlay(n_rows: int) -> pd.DataFrame:
+    '''
+    Make n_rows of fake tract x HOLC area overlay, with the messy answers
+    (and missing values) the real negro_yes_or_no column has.
+    '''
+    rng = np.random.default_rng(42)
+    answers = np.array(['Yes', 'No', 'None', 'Nominal', 'few', '2%', '0', 'Slight', 'no',
+                        '37 families', 'Scattered', 'Threat', 'N/A', '', None, np.nan], dtype=object)
+    fields = np.array(['Mixed. No negro infiltration.', 'Some negro families', 'No infiltration',
+                       'Good homes', 'Negro concentration to the east', 'NO NEGROES'], dtype=object)
+    return pd.DataFrame({
+        'GISJOIN': rng.integers(0, n_rows // 4, n_rows).astype(str),
+        'negro_yes_or_no': rng.choice(answers, n_rows),
+        'all_fields': rng.choice(fields, n_rows),
+        'grade': rng.choice(np.array(['A', 'B', 'C', 'D', None], dtype=object), n_rows),
+    })
+
+def bench_treatment(n_rows: int = 1_000_000):
+    overlay = fake_overlay(n_rows)
+
+    # Row level answers first, so any mismatch is easy to trace back
+    assert (overlay.negro_yes_or_no.apply(old_valid_response)
+            .equals(th.valid_responses(overlay.negro_yes_or_no)))
+    assert (overlay.all_fields.apply(old_patchwork_fixes)
+            .equals(th.patchwork_fixes(overlay.all_fields)))
+
+    start = perf_counter()
+    old = old_tract_treatment(overlay)
+    old_time = perf_counter() - start
+
+    start = perf_counter()
+    new = th.tract_treatment(overlay)
+    new_time = perf_counter() - start
+
+    tracts = overlay[['GISJOIN', 'grade']].drop_duplicates('GISJOIN')
+    old_merged, new_merged = tracts.merge(old, on='GISJOIN'), tracts.merge(new, on='GISJOIN')
+    assert old_merged.GISJOIN.equals(new_merged.GISJOIN) and \
+        (old_merged.nyn.astype(bool) == new_merged.nyn).all(), \
+        'tract_treatment no longer matches the old version!'
+    assert old_treatment_labels(old_merged.grade, old_merged.nyn) == \
+        th.treatment_labels(new_merged.grade, new_merged.nyn).tolist()
+    print(f'Treatment labelling of {n_rows} overlay rows: old {old_time:.2f}s, new {new_time:.2f}s')
+
+def fake_overlay_layers(n_side: int = 60) -> tuple[gpd.GeoDataFrame, gpd.GeoDataFrame]:
+    '''
+    Make an n_side x n_side grid of fake tracts and a coarser, offset grid of
+    fake HOLC areas over half of it, each with random grades.
+    '''
+    rng = np.random.default_rng(42)
+    grades = np.array(['A', 'B', 'C', 'D'], dtype=object)
+
+    x, y = np.meshgrid(np.arange(n_side), np.arange(n_side))
+    tracts = gpd.GeoDataFrame({
+        'GISJOIN': [f'G{i}' for i in range(n_side ** 2)],
+        'grade': rng.choice(grades, n_side ** 2),
+    }, geometry=shapely.box(x.ravel(), y.ravel(), x.ravel() + 1, y.ravel() + 1), crs='ESRI:102003')
+
+    x, y = np.meshgrid(np.arange(0.5, n_side / 2, 1.5), np.arange(0.5, n_side, 1.5))
+    areas = gpd.GeoDataFrame({
+        'area_id': np.arange(x.size),
+        'GRADE_HOLC': rng.choice(grades, x.size),
+    }, geometry=shapely.box(x.ravel(), y.ravel(), x.ravel() + 1.5, y.ravel() + 1.5), crs='ESRI:102003')
+    return tracts, areas
+
+def old_overlay_matching(tracts: gpd.GeoDataFrame, areas: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    '''
+    How fix_final_data.py used to overlay: everything, then filter on grade.
+    '''
+    overlay = tracts.overlay(areas)
+    return overlay[overlay.grade == overlay.GRADE_HOLC].reset_index(drop=True)
+
+def bench_overlay(n_side: int = 60):
+    tracts, areas = fake_overlay_layers(n_side)
+
+    old = timed(old_overlay_matching, tracts, areas)
+    new = timed(sh.overlay_matching, tracts, areas)
+
+    pairs = lambda df: set(zip(df.GISJOIN, df.area_id))
+    old_result, new_result = old_overlay_matching(tracts, areas), sh.overlay_matching(tracts, areas)
+    assert pairs(old_result) == pairs(new_result), 'overlay_matching no longer matches the old overlay!'
+    print(f'Overlay of {len(tracts)} tracts and {len(areas)} areas: old {old:.2f}s, new {new:.2f}s')
+
+BENCHMARKS = {
+    'accumulators': bench_accumulators,
+    'filter_text_col': bench_filter_text_col,
+    'arcgis_pages': bench_arcgis_pages,
+    'dms': bench_dms,
+    'storage': bench_storage,
+    'treatment': bench_treatment,
+    'overlay': bench_overlay,
+}
+
+if __name__ == "__main__":
+    # Run everything, or just the benchmarks named on the command line
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
@@ -1,82 +1,661 @@
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 import requests 
+import re
+import os
+import json
+import hashlib
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import chain, islice
+from typing import Iterator
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-def request_all_soda(url: str, default_params: dict, 
-                            rel_columns: list, offset_param='$offset') -> pd.DataFrame:
+# Number of pages to request at once in the concurrent SODA downloader
+MAX_WORKERS = 8
+
+# Number of sources to download or clean at once, and rows per chunk when
+# reading a raw download back in
+N_PROCESSES = min(5, os.cpu_count() or 1)
+CHUNK_SIZE = 50000
+
+# Standard columns every cleaned source ends up with
+CLEAN_COLUMNS = ['ID', 'city', 'year', 'latitude', 'longitude']
+
+# Retry settings for the shared HTTP session. Waits grow as
+# BACKOFF_FACTOR * 2 ** (retry - 1) seconds, or whatever Retry-After says.
+MAX_RETRIES = 6
+BACKOFF_FACTOR = 1
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+TIMEOUT = 120
+
+# Optional requests per second allowed for each host, e.g.
+# {'data.cityofnewyork.us': 5}. Hosts not listed aren't throttled by us.
+RATE_LIMITS = {}
+
+# Socrata throttles anonymous requests much harder than ones with an app token
+SODA_APP_TOKEN = os.environ.get('SODA_APP_TOKEN')
+
+class TokenBucket:
     '''
-    Request all results from a given SODA API url, until no new results
-    can be found. 
+    Thread safe token bucket allowing rate requests per second on average,
+    with bursts of up to capacity requests.
+    '''
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = max(1, rate) if capacity is None else capacity
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        '''
+        Block until a token is available, then take it.
+        '''
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+_session = None
+_buckets = {}
+_session_lock = threading.Lock()
+
+def get_session() -> requests.Session:
+    '''
+    Return the HTTP session shared by every fetcher, making it on first use.
+    It keeps connections alive, asks for gzip, and retries 429s and 5xxs with
+    exponential backoff.
+    '''
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(total=MAX_RETRIES, backoff_factor=BACKOFF_FACTOR,
+                          status_forcelist=RETRY_STATUSES, allowed_methods=['GET'],
+                          respect_retry_after_header=True, raise_on_status=False)
+            adapter = HTTPAdapter(max_retries=retry, pool_connections=16,
+                                  pool_maxsize=2 * MAX_WORKERS)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers['Accept-Encoding'] = 'gzip, deflate'
+            if SODA_APP_TOKEN:
+                session.headers['X-App-Token'] = SODA_APP_TOKEN
+            _session = session
+        return _session
+
+def http_get(url: str, params: dict = None) -> requests.Response:
+    '''
+    GET url through the shared session, waiting on the host's token bucket if
+    it has one in RATE_LIMITS. Raises an HTTPError if the request still fails
+    once the retries run out, rather than handing back an error body.
+    '''
+    host = urlparse(url).netloc
+    if host in RATE_LIMITS:
+        with _session_lock:
+            bucket = _buckets.setdefault(host, TokenBucket(RATE_LIMITS[host]))
+        bucket.acquire()
+
+    response = get_session().get(url, params=params, timeout=TIMEOUT)
+    if response.status_code != 200:
+        print(f"Error: {response.status_code} - {response.text}")
+        print(f"\tUrl: {response.url}")
+        response.raise_for_status()
+
+    return response
+
+class PageAccumulator:
+    '''
+    Collects pages of results and deduplicates them as they arrive, so that
+    the full dataframe is only built once at the end instead of being
+    re-concatenated and re-hashed after every page.
+
+    If key is given, rows are deduplicated on that record id column.
+    Otherwise whole rows are hashed, matching the old drop_duplicates().
+    Set keep_pages to False to only track which rows have been seen, e.g.
+    when the pages are being streamed to disk.
+    '''
+
+    def __init__(self, key: str = None, keep_pages: bool = True):
+        self.key = key
+        self.keep_pages = keep_pages
+        self.pages = []
+        self.seen = set()
+        self.n_rows = 0
+
+    def _row_keys(self, page: pd.DataFrame) -> list:
+        if self.key is not None:
+            return page[self.key].tolist()
+        return pd.util.hash_pandas_object(page, index=False).tolist()
+
+    def add(self, page: pd.DataFrame) -> pd.DataFrame:
+        '''
+        Add a page, dropping rows we have already seen. Returns the new rows.
+        '''
+        keep = []
+        for k in self._row_keys(page):
+            keep.append(k not in self.seen)
+            self.seen.add(k)
+
+        page = page[keep]
+        if len(page) > 0:
+            if self.keep_pages:
+                self.pages.append(page)
+            self.n_rows += len(page)
+
+        return page
+
+    def to_frame(self, columns: list = None) -> pd.DataFrame:
+        '''
+        Build the deduplicated dataframe from every page added so far.
+        '''
+        return collect_pages(self.pages, columns)
+
+def collect_pages(pages: Iterator[pd.DataFrame], columns: list = None) -> pd.DataFrame:
+    '''
+    Concatenate a stream of pages into one dataframe.
+    '''
+    pages = list(pages)
+    if len(pages) == 0:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(pages, ignore_index=True)
+
+def read_raw(loc: str, chunksize: int = None):
+    '''
+    Read a raw JSON Lines download back exactly as it was written, or an
+    iterator over chunks of it if chunksize is given. No dtypes are guessed
+    and no dates parsed: pandas would otherwise turn columns like Created_At
+    into datetimes, which parse_year and the high water marks don't expect.
+    '''
+    return pd.read_json(loc, lines=True, chunksize=chunksize, dtype=False,
+                        convert_dates=False)
+
+def manifest_path(loc: str) -> str:
+    '''
+    Where the checkpoint manifest for the download at loc lives.
+    '''
+    return f'{loc}.manifest.json'
+
+def read_manifest(loc: str) -> dict:
+    '''
+    Read the checkpoint manifest for the download at loc, or an empty one
+    if the download has never been started.
+    '''
+    if not os.path.exists(manifest_path(loc)):
+        return {'offset': 0, 'pages': [], 'complete': False}
+    with open(manifest_path(loc)) as f:
+        return json.load(f)
+
+def write_manifest(loc: str, manifest: dict) -> None:
+    '''
+    Atomically replace the checkpoint manifest for the download at loc.
+    '''
+    tmp = f'{manifest_path(loc)}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, manifest_path(loc))
+
+def download_complete(loc: str) -> bool:
+    '''
+    Return whether the download at loc has finished. Files fetched before we
+    kept manifests count as finished if they exist.
+    '''
+    if not os.path.exists(loc):
+        return False
+    return read_manifest(loc)['complete'] or not os.path.exists(manifest_path(loc))
+
+def legacy_path(loc: str) -> str | None:
+    '''
+    Where downloads from before we streamed to JSON Lines kept the download
+    at loc: the same name, but .json instead of .jsonl.
+    '''
+    return f'{loc[:-len(".jsonl")]}.json' if loc.endswith('.jsonl') else None
+
+def migrate_legacy(loc: str, columns: list[str], key: str = None,
+                   date_column: str = None) -> bool:
+    '''
+    If a finished download of loc exists in the old .json layout and has
+    every one of columns, rewrite it as JSON Lines at loc (with a complete
+    manifest) instead of fetching it again, and return True. The old file is
+    left where it is either way.
+    '''
+    legacy = legacy_path(loc)
+    if legacy is None or not os.path.exists(legacy):
+        return False
+
+    df = pd.read_json(legacy, dtype=False, convert_dates=False).reset_index(drop=True)
+    missing = [col for col in columns if col not in df.columns]
+    if missing:
+        # e.g. the old LA 311 files, which had no dates
+        print(f'{legacy} has no {", ".join(missing)}, fetching {loc} again.')
+        return False
+
+    print(f'Converting {legacy} to {loc}')
+    # Whatever a later run may have started is superseded by the old download
+    write_manifest(loc, {'offset': 0, 'pages': [], 'complete': False})
+    if os.path.exists(f'{loc}.part'):
+        os.remove(f'{loc}.part')
+
+    stream_to_file([df[columns]], loc, key=key, date_column=date_column)
+    return True
+
+def resume_offset(loc: str) -> int:
+    '''
+    Check the partial download for loc against its manifest and return the
+    offset to restart from. Pages whose bytes don't match their recorded
+    hash, and anything written after the last committed page, are thrown
+    away.
+    '''
+    part_loc = f'{loc}.part'
+    manifest = read_manifest(loc)
+
+    if not os.path.exists(part_loc) or len(manifest['pages']) == 0:
+        write_manifest(loc, {'offset': 0, 'pages': [], 'complete': False})
+        if os.path.exists(part_loc):
+            os.remove(part_loc)
+        return 0
+
+    good_pages, good_bytes = [], 0
+    with open(part_loc, 'rb') as f:
+        for page in manifest['pages']:
+            content = f.read(page['bytes'])
+            if hashlib.sha256(content).hexdigest() != page['sha256']:
+                print(f"Page at offset {page['offset']} of {loc} is corrupt, refetching from there.")
+                break
+            good_pages.append(page)
+            good_bytes += page['bytes']
+
+    with open(part_loc, 'r+b') as f:
+        f.truncate(good_bytes)
+
+    offset = good_pages[-1]['next_offset'] if good_pages else 0
+    write_manifest(loc, {'offset': offset, 'pages': good_pages, 'complete': False})
+    print(f'Resuming {loc} from offset {offset} ({len(good_pages)} pages on disk).')
+
+    return offset
+
+def max_value(values: pd.Series):
+    '''
+    The largest non-null value in values as a plain python object (so it can
+    go in a manifest), or None if there isn't one.
+    '''
+    values = values.dropna()
+    if len(values) == 0:
+        return None
+    value = values.max()
+    return value.item() if hasattr(value, 'item') else value
+
+def stream_to_file(pages: Iterator[pd.DataFrame], loc: str, key: str = None,
+                   date_column: str = None) -> int:
+    '''
+    Write each page in a stream of pages straight to a JSON Lines file at loc,
+    so only one page is ever held in memory. Pages are appended to loc.part,
+    which is renamed to loc once the stream is exhausted; a half finished
+    download therefore never looks like a finished one.
+
+    After every page the manifest next to loc records the offset to resume
+    from and the size and sha256 of each page written. If the manifest already
+    has pages (see resume_offset), new pages are appended after them, skipping
+    any record whose key is already on disk. If date_column is given, each
+    page also records the newest date in it, for incremental refreshes.
+
+    Returns the number of rows written.
+    '''
+    part_loc = f'{loc}.part'
+    manifest = read_manifest(loc)
+    n_rows = sum(page['rows'] for page in manifest['pages'])
+
+    seen = PageAccumulator(key, keep_pages=False)
+    if key is not None and n_rows > 0:
+        for chunk in read_raw(part_loc, chunksize=50000):
+            seen.add(chunk)
+
+    with open(part_loc, 'ab' if n_rows > 0 else 'wb') as f:
+        for page in pages:
+            next_offset = page.attrs.get('next_offset', n_rows + len(page))
+            if key is not None:
+                page = seen.add(page)
+
+            lines = page.to_json(orient='records', lines=True) if len(page) > 0 else ''
+            if lines and not lines.endswith('\n'):
+                lines += '\n'
+            content = lines.encode('utf-8')
+
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+
+            manifest['pages'].append({
+                'offset': manifest['offset'],
+                'next_offset': next_offset,
+                'rows': len(page),
+                'bytes': len(content),
+                'sha256': hashlib.sha256(content).hexdigest(),
+                'high_water': max_value(page[date_column]) if date_column and len(page) > 0 else None
+            })
+            manifest['offset'] = next_offset
+            write_manifest(loc, manifest)
+            n_rows += len(page)
+
+    os.replace(part_loc, loc)
+    manifest['complete'] = True
+    if date_column is not None:
+        manifest['high_water'] = max_value(pd.Series(
+            [page.get('high_water') for page in manifest['pages']], dtype=object))
+    write_manifest(loc, manifest)
+    print(f'Wrote {n_rows} rows to {loc}')
+    return n_rows
+
+def high_water_mark(loc: str, date_column: str):
+    '''
+    Return the newest value of date_column in the finished download at loc,
+    from its manifest if we have one and by scanning the file otherwise.
+    '''
+    high_water = read_manifest(loc).get('high_water')
+    if high_water is not None:
+        return high_water
+
+    newest = [max_value(chunk[date_column]) for chunk in read_raw(loc, chunksize=50000)]
+    return max_value(pd.Series(newest, dtype=object))
+
+# Name of the where filter parameter for each paging style
+WHERE_PARAMS = {'soda': '$where', 'arcgis': 'where', 'carto': 'where'}
+
+def and_where(default_params: dict, style: str, clause: str) -> dict:
+    '''
+    Copy default_params, ANDing clause onto its where filter (or making it
+    the filter if there isn't one).
+    '''
+    params = dict(default_params)
+    where_param = WHERE_PARAMS[style]
+    if params.get(where_param):
+        clause = f"({params[where_param]}) AND {clause}"
+    params[where_param] = clause
+    return params
+
+def date_clause(style: str, date_column: str, op: str, value) -> str:
+    '''
+    A where clause comparing date_column to value with op, e.g. '>='.
+
+    Inputs:
+      style (str): 'soda', 'arcgis' or 'carto', which decides the syntax.
+      value: an ISO date string, a year, or (for ArcGIS date fields) an
+        epoch in milliseconds.
+    '''
+    if style != 'arcgis':
+        return f"{date_column} {op} '{value}'"
+    if isinstance(value, (int, float)) and value > 10000:
+        stamp = pd.to_datetime(value, unit='ms').strftime('%Y-%m-%d %H:%M:%S')
+        return f"{date_column} {op} TIMESTAMP '{stamp}'"
+    if isinstance(value, (int, float)):
+        return f"{date_column} {op} {value}"
+    return f"{date_column} {op} TIMESTAMP '{value}'"
+
+def delta_filter(default_params: dict, style: str, date_column: str, high_water,
+                 until=None) -> dict:
+    '''
+    Copy default_params, adding clauses to the where filter that only keep
+    rows with date_column at or after high_water, and at or before until if
+    it's given. Rows exactly at the high water mark are fetched again and
+    merged away by key. See date_clause for the formats of the two bounds.
+    '''
+    params = and_where(default_params, style, date_clause(style, date_column, '>=', high_water))
+    if until is not None:
+        params = and_where(params, style, date_clause(style, date_column, '<=', until))
+    return params
+
+def merge_into(loc: str, delta_loc: str, key: str, date_column: str = None) -> int:
+    '''
+    Merge the rows of the download at delta_loc into the download at loc by
+    record id, keeping the delta's version of any record in both. The old
+    file is streamed through in chunks, so this never holds it in memory.
+
+    Returns the number of rows in the merged file.
+    '''
+    delta = read_raw(delta_loc)
+    if len(delta) == 0:
+        # An empty download reads back with no columns at all
+        os.remove(delta_loc)
+        os.remove(manifest_path(delta_loc))
+        with open(loc, 'rb') as f:
+            n_rows = sum(1 for _ in f)
+        print(f'No new rows for {loc}, still {n_rows} rows.')
+        return n_rows
+
+    delta_keys = set(delta[key].tolist())
+
+    tmp_loc = f'{loc}.merging'
+    sha, n_bytes, n_rows = hashlib.sha256(), 0, 0
+    with open(tmp_loc, 'wb') as f:
+        chunks = read_raw(loc, chunksize=50000)
+        for chunk in chain(chunks, [delta]):
+            if chunk is not delta:
+                chunk = chunk[[k not in delta_keys for k in chunk[key].tolist()]]
+            if len(chunk) == 0:
+                continue
+            lines = chunk.to_json(orient='records', lines=True)
+            if not lines.endswith('\n'):
+                lines += '\n'
+            content = lines.encode('utf-8')
+            f.write(content)
+            sha.update(content)
+            n_bytes += len(content)
+            n_rows += len(chunk)
+
+    high_water = None
+    if date_column is not None:
+        high_water = max_value(pd.Series([high_water_mark(loc, date_column),
+                                          max_value(delta[date_column])], dtype=object))
+
+    os.replace(tmp_loc, loc)
+    write_manifest(loc, {
+        'offset': n_rows,
+        'pages': [{'offset': 0, 'next_offset': n_rows, 'rows': n_rows, 'bytes': n_bytes,
+                   'sha256': sha.hexdigest(), 'high_water': high_water}],
+        'complete': True,
+        'high_water': high_water
+    })
+    os.remove(delta_loc)
+    os.remove(manifest_path(delta_loc))
+
+    print(f'Merged {len(delta)} new or updated rows into {loc}, now {n_rows} rows.')
+    return n_rows
+
+def iter_soda_pages(url: str, default_params: dict, 
+                    rel_columns: list, offset_param='$offset',
+                    key: str = None, start_offset: int = 0) -> Iterator[pd.DataFrame]:
+    '''
+    Yield pages of results from a given SODA API url, until no new results
+    can be found. Rows already yielded are not yielded again.
 
     Inputs:
       url (str): the base url to make requests from. Should be the json format
       default_params (dict): dictionary of additional params for request.
       rel_columns (list): columns to keep.
-    
-    Returns: dataframe with features rel_columns containing all relevant results
-      from the SODA API.
+      key (str): record id column to deduplicate on. Whole rows if None.
+      start_offset (int): the offset of the first page to request.
+
+    Each page's attrs['next_offset'] is the offset to resume from after it.
     '''
 
-    df = None
-    got_bigger, prior_size = True, 0
-    while got_bigger:
+    seen = PageAccumulator(key, keep_pages=False)
+    default_params[offset_param] = f'{start_offset}'
+    while True:
 
-        response = requests.get(url, params=default_params)
-        if response.status_code != 200:
-            print(f"Error: {response.status_code} - {response.text}")
-            print(f"\tUrl: {response.url}")
+        response = http_get(url, params=default_params)
         
         print('response received!')
         next_chunk = pd.DataFrame(response.json())
         
         if len(next_chunk) == 0:
             print('Oopsie, out of new entries!')
-            return df
-
-        if df is None:
-            df = next_chunk.copy()
-            print(df.columns)
-            print(df)
-            df = df[rel_columns]
-            prior_size = df.shape[0]
-            default_params[offset_param] = f'{prior_size}'
-            continue
-
-        df = pd.concat([df, next_chunk[rel_columns]], ignore_index=True)\
-            .drop_duplicates()
-        
-        if prior_size == len(df):
-            prior_size = False
+            return
 
-        prior_size=df.shape[0]
-        default_params[offset_param] = f'{prior_size}'
+        new_rows = seen.add(next_chunk.reindex(columns=rel_columns))
+        if len(new_rows) == 0:
+            return
 
-        print(f"DataFrame is now at {prior_size} rows.")
+        default_params[offset_param] = f'{start_offset + seen.n_rows}'
+        new_rows.attrs['next_offset'] = start_offset + seen.n_rows
+        print(f"Fetched {seen.n_rows} rows so far.")
 
-    return df
-        
-def request_all_soda_la(url: str, default_params: dict, 
-                            rel_columns: list, offset_param='$offset') -> pd.DataFrame:
+        yield new_rows
+
+def request_all_soda(url: str, default_params: dict, 
+                            rel_columns: list, offset_param='$offset',
+                            key: str = None) -> pd.DataFrame:
     '''
-    Request all traffic crash results from Los Angeles, a city where the output format
-    is just incredibly cursed.
+    Request all results from a given SODA API url, until no new results
+    can be found. 
 
     Inputs:
       url (str): the base url to make requests from. Should be the json format
       default_params (dict): dictionary of additional params for request.
       rel_columns (list): columns to keep.
+      key (str): record id column to deduplicate on. Whole rows if None.
     
     Returns: dataframe with features rel_columns containing all relevant results
       from the SODA API.
     '''
+    return collect_pages(iter_soda_pages(url, default_params, rel_columns,
+                                         offset_param, key), rel_columns)
+
+def soda_row_count(url: str, default_params: dict) -> int:
+    '''
+    Ask a SODA API url how many rows match default_params, using a
+    $select=count(*) query with the same $where clause.
+    '''
+    count_params = {k: v for k, v in default_params.items()
+                    if k not in ('$limit', '$offset', '$order', '$select')}
+    count_params['$select'] = 'count(*)'
+
+    response = http_get(url, params=count_params)
+
+    # Socrata names the column count or count_1 depending on the version
+    return int(list(response.json()[0].values())[0])
+
+def request_soda_page(url: str, default_params: dict, rel_columns: list,
+                      offset: int, offset_param='$offset') -> pd.DataFrame:
+    '''
+    Request a single page of a SODA API url starting at offset.
+    '''
+    params = dict(default_params)
+    params[offset_param] = f'{offset}'
+
+    response = http_get(url, params=params)
+
+    page = pd.DataFrame(response.json())
+    # Sparse pages may omit columns entirely
+    return page.reindex(columns=rel_columns)
+
+def iter_soda_pages_concurrent(url: str, default_params: dict,
+                               rel_columns: list, offset_param='$offset',
+                               key: str = None, start_offset: int = 0,
+                               max_workers: int = MAX_WORKERS) -> Iterator[pd.DataFrame]:
+    '''
+    Yield every page of a SODA API url in offset order, counting the rows up
+    front and keeping up to 2 * max_workers page requests in flight. Only the
+    pages in flight are ever held in memory.
 
-    df = None
-    got_bigger, prior_size = True, 0
+    Inputs:
+      url (str): the base url to make requests from. Should be the json format
+      default_params (dict): dictionary of additional params for request. Should
+        contain a $limit (page size) and an $order so paging is stable.
+      rel_columns (list): columns to keep.
+      key (str): record id column to deduplicate on. Whole rows if None.
+      start_offset (int): the offset of the first page to request.
+      max_workers (int): the most requests to have in flight at once.
+
+    Each page's attrs['next_offset'] is the offset to resume from after it.
+    '''
+    n_rows = soda_row_count(url, default_params)
+    page_size = int(default_params['$limit'])
+    offsets = iter(range(start_offset, n_rows, page_size))
+    print(f'Expecting {n_rows} rows, starting from row {start_offset}.')
+
+    seen = PageAccumulator(key, keep_pages=False)
+
+    def fetch(offset):
+        return request_soda_page(url, default_params, rel_columns,
+                                 offset, offset_param)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        in_flight = deque((offset, pool.submit(fetch, offset))
+                          for offset in islice(offsets, 2 * max_workers))
+        while in_flight:
+            page_offset, page = in_flight.popleft()
+            page = page.result()
+
+            next_offset = next(offsets, None)
+            if next_offset is not None:
+                in_flight.append((next_offset, pool.submit(fetch, next_offset)))
+
+            new_rows = seen.add(page)
+            new_rows.attrs['next_offset'] = page_offset + page_size
+            print(f"Fetched {seen.n_rows} rows so far.")
+            yield new_rows
 
-    while got_bigger:
+def request_all_soda_concurrent(url: str, default_params: dict,
+                                rel_columns: list, offset_param='$offset',
+                                key: str = None,
+                                max_workers: int = MAX_WORKERS) -> pd.DataFrame:
+    '''
+    Request all results from a given SODA API url by counting the rows up
+    front and fetching the pages with a bounded thread pool. Pages are put
+    back in offset order, so this is a drop in replacement for
+    request_all_soda.
+
+    Inputs:
+      url (str): the base url to make requests from. Should be the json format
+      default_params (dict): dictionary of additional params for request. Should
+        contain a $limit (page size) and an $order so paging is stable.
+      rel_columns (list): columns to keep.
+      key (str): record id column to deduplicate on. Whole rows if None.
+      max_workers (int): the most requests to have in flight at once.
+    
+    Returns: dataframe with features rel_columns containing all relevant results
+      from the SODA API.
+    '''
+    pages = iter_soda_pages_concurrent(url, default_params, rel_columns,
+                                       offset_param, key, max_workers=max_workers)
+    return collect_pages(pages, rel_columns)
 
-        response = requests.get(url, params=default_params)
-        if response.status_code != 200:
-            print(f"Error: {response.status_code} - {response.text}")
+def iter_soda_la_pages(url: str, default_params: dict, 
+                       rel_columns: list, offset_param='$offset',
+                       key: str = None, start_offset: int = 0) -> Iterator[pd.DataFrame]:
+    '''
+    Yield pages of traffic crash results from Los Angeles, a city where the
+    output format is just incredibly cursed.
+
+    Inputs:
+      url (str): the base url to make requests from. Should be the json format
+      default_params (dict): dictionary of additional params for request.
+      rel_columns (list): columns to keep.
+      key (str): record id column to deduplicate on. Whole rows if None.
+      start_offset (int): the offset of the first page to request.
+
+    Each page's attrs['next_offset'] is the offset to resume from after it.
+    '''
+
+    seen = PageAccumulator(key, keep_pages=False)
+    default_params[offset_param] = f'{start_offset}'
+
+    while True:
+
+        response = http_get(url, params=default_params)
         
         print('response received!')
         # so this will throw an error atm
@@ -95,94 +674,369 @@ def request_all_soda_la(url: str, default_params: dict,
 
         if len(next_chunk) == 0:
             print('Oopsie, out of new entries!')
-            return df
-
-        if df is None:
-            df = next_chunk.copy()
-            print(df.columns)
-            print(df)
-            df = df[rel_columns]
-            prior_size = df.shape[0]
-            default_params[offset_param] = f'{prior_size}'
-            continue
-
-        df = pd.concat([df, next_chunk[rel_columns]], ignore_index=True)\
-            .drop_duplicates()
-        
-        if prior_size == len(df):
-            got_bigger = False
-
-        prior_size=df.shape[0]
-        default_params[offset_param] = f'{prior_size}'
+            return
 
-        print(f"DataFrame is now at {prior_size} rows.")
+        new_rows = seen.add(next_chunk[rel_columns])
+        if len(new_rows) == 0:
+            return
 
-    return df
-        
+        default_params[offset_param] = f'{start_offset + seen.n_rows}'
+        new_rows.attrs['next_offset'] = start_offset + seen.n_rows
+        print(f"Fetched {seen.n_rows} rows so far.")
 
+        yield new_rows
 
-def request_all_arcgis(url: str, default_params: dict, 
-                            rel_columns: list, offset_param='resultOffset',
-                            paranoid: bool = False) -> pd.DataFrame:
+def request_all_soda_la(url: str, default_params: dict, 
+                            rel_columns: list, offset_param='$offset',
+                            key: str = None) -> pd.DataFrame:
     '''
-    Request all results from a given SODA API url, until no new results
-    can be found. 
+    Request all traffic crash results from Los Angeles, a city where the output format
+    is just incredibly cursed.
 
     Inputs:
       url (str): the base url to make requests from. Should be the json format
       default_params (dict): dictionary of additional params for request.
       rel_columns (list): columns to keep.
-      paranoid (bool): Set to True if you're paranoid that you aren't getting good data.
+      key (str): record id column to deduplicate on. Whole rows if None.
     
     Returns: dataframe with features rel_columns containing all relevant results
       from the SODA API.
     '''
+    return collect_pages(iter_soda_la_pages(url, default_params, rel_columns,
+                                            offset_param, key), rel_columns)
 
-    df = None
-    got_bigger, prior_size = True, 0
+def arcgis_page_frame(payload: dict, rel_columns: list) -> pd.DataFrame:
+    '''
+    Build a page of results from a parsed ArcGIS query response in one go,
+    straight from the attributes records of its features.
+    '''
+    if 'error' in payload:
+        raise requests.HTTPError(f"ArcGIS error: {payload['error']}")
 
-    while got_bigger:
+    records = [feature['attributes'] for feature in payload.get('features', [])]
+    return pd.DataFrame.from_records(records, columns=rel_columns)
 
-        response = requests.get(url, params=default_params)
-        if response.status_code != 200:
-            print(f"Error: {response.status_code} - {response.text}")
+def iter_arcgis_pages(url: str, default_params: dict, 
+                      rel_columns: list, offset_param='resultOffset',
+                      paranoid: bool = False, key: str = None,
+                      start_offset: int = 0) -> Iterator[pd.DataFrame]:
+    '''
+    Yield pages of results from a given ArcGIS feature server url, until the
+    server stops saying it has more (exceededTransferLimit) or no new results
+    can be found. Geometry is never requested, since every layer we use has
+    its coordinates as attributes.
 
-        # we're done and things were Oddly Even
-        if len(list(response.json()['features'])) == 0:
-            return df 
-        
-        next_chunk = [pd.DataFrame(response.json()['features'][i]['attributes'], index=[i]) 
-                      for i in range(len(list(response.json()['features'])))]
-        next_chunk = pd.concat(next_chunk, ignore_index=True)
+    Inputs:
+      url (str): the base url to make requests from. Should be the json format
+      default_params (dict): dictionary of additional params for request.
+      rel_columns (list): columns to keep.
+      paranoid (bool): Set to True if you're paranoid that you aren't getting good data.
+      key (str): record id column to deduplicate on. Whole rows if None.
+      start_offset (int): the offset of the first page to request.
+
+    Each page's attrs['next_offset'] is the offset to resume from after it.
+    '''
+
+    seen = PageAccumulator(key, keep_pages=False)
+    default_params[offset_param] = f'{start_offset}'
+    default_params.setdefault('returnGeometry', 'false')
+    page_size = int(default_params.get('resultRecordCount', 0))
+
+    while True:
 
+        payload = http_get(url, params=default_params).json()
+        next_chunk = arcgis_page_frame(payload, rel_columns)
+
+        # we're done and things were Oddly Even
         if len(next_chunk) == 0:
             print('Oopsie, out of new entries!')
-            return df
-
-        if df is None:
-            df = next_chunk.copy()
-            print(df.columns)
-            print(df)
-            df = df[rel_columns]
-            prior_size = df.shape[0]
-            default_params[offset_param] = f'{prior_size}'
-            continue
-
-        df = pd.concat([df, next_chunk[rel_columns]], ignore_index=True)\
-            .drop_duplicates()
-        
-        if prior_size == len(df):
-            prior_size = False
+            return
 
-        prior_size=df.shape[0]
-        default_params[offset_param] = f'{prior_size}'
+        new_rows = seen.add(next_chunk)
+        if len(new_rows) == 0:
+            return
 
-        print(f"DataFrame is now at {prior_size} rows.")
+        default_params[offset_param] = f'{start_offset + seen.n_rows}'
+        new_rows.attrs['next_offset'] = start_offset + seen.n_rows
+
+        print(f"Fetched {seen.n_rows} rows so far.")
         if paranoid:
             print('Hey paranoid, here\'s the head:')
             print(next_chunk.head())
 
-    return df
+        yield new_rows
+
+        # A short page with no more to come is the last one. Servers that cap
+        # pages below resultRecordCount keep setting exceededTransferLimit.
+        if not payload.get('exceededTransferLimit', False) and len(next_chunk) < page_size:
+            return
+
+def iter_carto_pages(url: str, default_params: dict, rel_columns: list,
+                     key: str = None, start_offset: int = 0) -> Iterator[pd.DataFrame]:
+    '''
+    Yield pages of results from a Carto SQL API url (Philadelphia's open
+    data), paging with LIMIT and OFFSET in key order.
+
+    Inputs:
+      url (str): the SQL API url.
+      default_params (dict): the table to query, plus optional where, select
+        and limit (page size) entries.
+      rel_columns (list): columns to keep.
+      key (str): record id column to order and deduplicate on.
+      start_offset (int): the offset of the first page to request.
+
+    Each page's attrs['next_offset'] is the offset to resume from after it.
+    '''
+    seen = PageAccumulator(key, keep_pages=False)
+    offset = start_offset
+    limit = int(default_params.get('limit', 50000))
+
+    query = f"SELECT {default_params.get('select', '*')} FROM {default_params['table']}"
+    if default_params.get('where'):
+        query += f" WHERE {default_params['where']}"
+    if key is not None:
+        query += f" ORDER BY {key}"
+
+    while True:
+        payload = http_get(url, params={'q': f'{query} LIMIT {limit} OFFSET {offset}'}).json()
+        next_chunk = pd.DataFrame.from_records(payload['rows'], columns=rel_columns)
+
+        if len(next_chunk) == 0:
+            print('Oopsie, out of new entries!')
+            return
+
+        offset += len(next_chunk)
+        new_rows = seen.add(next_chunk)
+        new_rows.attrs['next_offset'] = offset
+        print(f"Fetched {seen.n_rows} rows so far.")
+
+        yield new_rows
+
+        if len(next_chunk) < limit:
+            return
+
+def request_all_arcgis(url: str, default_params: dict, 
+                            rel_columns: list, offset_param='resultOffset',
+                            paranoid: bool = False, key: str = None) -> pd.DataFrame:
+    '''
+    Request all results from a given ArcGIS feature server url, until no new
+    results can be found. 
+
+    Inputs:
+      url (str): the base url to make requests from. Should be the json format
+      default_params (dict): dictionary of additional params for request.
+      rel_columns (list): columns to keep.
+      paranoid (bool): Set to True if you're paranoid that you aren't getting good data.
+      key (str): record id column to deduplicate on. Whole rows if None.
+    
+    Returns: dataframe with features rel_columns containing all relevant results
+      from the ArcGIS API.
+    '''
+    return collect_pages(iter_arcgis_pages(url, default_params, rel_columns,
+                                           offset_param, paranoid, key), rel_columns)
+
+def term_filter_clause(text_column: str, terms: list[str]) -> str:
+    '''
+    Build a where clause keeping rows whose text_column contains any of terms,
+    ignoring case. The syntax is shared by SoQL, ArcGIS standardized queries
+    and Carto's SQL.
+    '''
+    likes = []
+    for term in terms:
+        term = term.lower().replace("'", "''")
+        likes.append(f"lower({text_column}) like '%{term}%'")
+
+    return f"({' OR '.join(likes)})"
+
+def with_pushdown(default_params: dict, style: str, columns: list[str],
+                  text_column: str = None, terms: list[str] = None) -> dict:
+    '''
+    Copy default_params, asking the server for only columns and, if terms are
+    given, only the rows whose text_column mentions one of them, so that
+    filtering happens before anything is sent over the wire.
+
+    Inputs:
+      style (str): 'soda', 'arcgis' or 'carto', which decides the parameter names.
+    '''
+    select_param = {'soda': '$select', 'arcgis': 'outFields', 'carto': 'select'}[style]
+    params = {**default_params, select_param: ','.join(columns)}
+
+    if terms:
+        params = and_where(params, style, term_filter_clause(text_column, terms))
+
+    return params
+
+def iter_source_pages(source: dict, params: dict = None, start_offset: int = 0,
+                      window: bool = True) -> Iterator[pd.DataFrame]:
+    '''
+    Yield the pages of a source config (an entry of sources.CRASH_SOURCES or
+    sources.REQUEST_SOURCES) with the fetcher for its paging style: 'soda',
+    'soda_la', 'arcgis' or 'carto'. params overrides the config's own params.
+
+    Only the config's columns are requested, and if it has a text_column and
+    terms, only rows mentioning one of the terms. Unless window is False, only
+    rows inside the config's study window are requested too (refreshes pass
+    False, since their delta filter already bounds the dates).
+    '''
+    style = source['style']
+    params = source['params'] if params is None else params
+    columns = source['columns']
+    if style == 'soda_la':
+        # LA only has its coordinates nested inside location_1
+        columns = [c for c in columns if c not in ('latitude', 'longitude')] + ['location_1']
+    if window and source.get('window'):
+        params = and_where(params, style.replace('_la', ''), source['window'])
+    params = with_pushdown(params, style.replace('_la', ''), columns,
+                           source.get('text_column'), source.get('terms'))
+
+    if style == 'soda':
+        return iter_soda_pages_concurrent(source['url'], params, source['columns'],
+                                          source['offset_param'], key=source['key'],
+                                          start_offset=start_offset)
+    if style == 'soda_la':
+        return iter_soda_la_pages(source['url'], params, source['columns'],
+                                  source['offset_param'], key=source['key'],
+                                  start_offset=start_offset)
+    if style == 'arcgis':
+        return iter_arcgis_pages(source['url'], params, source['columns'],
+                                 source['offset_param'], paranoid=source.get('paranoid', False),
+                                 key=source['key'], start_offset=start_offset)
+    if style == 'carto':
+        return iter_carto_pages(source['url'], params, source['columns'],
+                                key=source['key'], start_offset=start_offset)
+
+    raise ValueError(f'Unknown paging style {style}')
+
+def download_source(source: dict, loc: str) -> int:
+    '''
+    Download a source config to loc, picking up where any earlier run left off.
+    '''
+    pages = iter_source_pages(source, start_offset=resume_offset(loc))
+    return stream_to_file(pages, loc, key=source['key'],
+                          date_column=source.get('date_column'))
+
+def refresh_source(source: dict, loc: str) -> int:
+    '''
+    Fetch only the rows of a source config newer than the high water mark of
+    its finished download at loc, up to the end of its study window, and
+    merge them into it by record id.
+    '''
+    date_column = source['date_column']
+    high_water = high_water_mark(loc, date_column)
+    if high_water is None:
+        print(f'No {date_column} values in {loc}, refetching everything.')
+        os.remove(loc)
+        return download_source(source, loc)
+
+    print(f'Fetching rows of {loc} with {date_column} >= {high_water}')
+    delta_loc = f'{loc}.delta'
+    delta_params = delta_filter(source['params'], source['style'].replace('_la', ''),
+                                date_column, high_water, source.get('window_end'))
+    pages = iter_source_pages(source, params=delta_params,
+                              start_offset=resume_offset(delta_loc), window=False)
+    stream_to_file(pages, delta_loc, key=source['key'], date_column=date_column)
+
+    return merge_into(loc, delta_loc, source['key'], date_column)
+
+def ingest_source(source: dict, loc: str, refresh: bool = False) -> None:
+    '''
+    Download a source config to loc if we don't have it yet, or refresh it
+    if we do and refresh is set. A finished download in the old .json layout
+    counts as having it, and is converted rather than fetched again.
+    '''
+    if not download_complete(loc) and \
+            not migrate_legacy(loc, source['columns'], source['key'], source.get('date_column')):
+        print(f'Requesting data for {loc}')
+        download_source(source, loc)
+    elif refresh:
+        print(f'Refreshing data for {loc}')
+        refresh_source(source, loc)
+    else:
+        print(f'Data exits for {loc}, skipping!')
+
+def ingest_sources(sources: dict, save_loc: str, refresh: bool = False,
+                   n_workers: int = N_PROCESSES) -> None:
+    '''
+    Download (or refresh) every source in a registry into save_loc, several
+    sources at a time. Fetching is I/O bound, so the sources share threads
+    rather than processes: that way every source on a host draws on the one
+    session and the one RATE_LIMITS bucket for it.
+    '''
+    locs = [f"{save_loc}/{source['file_name']}" for source in sources.values()]
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        # list() so that errors in the workers are raised here
+        list(pool.map(ingest_source, sources.values(), locs, [refresh] * len(locs)))
+
+def parse_year(values: pd.Series, year_format: str) -> pd.Series:
+    '''
+    Turn a column of dates into years. year_format is 'iso' for date strings,
+    'int' for columns that are already years, or 'epoch_ms' for ArcGIS dates.
+    '''
+    if year_format == 'iso':
+        return pd.to_numeric(values.astype(str).str[:4], errors='coerce')
+    if year_format == 'int':
+        return pd.to_numeric(values, errors='coerce')
+    if year_format == 'epoch_ms':
+        return pd.to_datetime(pd.to_numeric(values, errors='coerce'), unit='ms').dt.year
+
+    raise ValueError(f'Unknown year format {year_format}')
+
+def clean_page(page: pd.DataFrame, source: dict) -> pd.DataFrame:
+    '''
+    Normalize a page of raw rows from a source config into CLEAN_COLUMNS
+    (plus request_type for sources with a text_column): prefixed IDs, integer
+    years, decimal coordinates, no null island and nothing outside the
+    source's bounds. Rows without the source's terms are dropped again here
+    as a check on the server side filter.
+    '''
+    if source.get('terms'):
+        page = filter_text_col(page, source['text_column'], source['terms'])
+
+    lat, lon = page[source['lat_column']], page[source['lon_column']]
+    if source.get('coord_format') == 'dms':
+        lat, lon = dms_to_decimal(lat), dms_to_decimal(lon)
+    lat, lon = pd.to_numeric(lat, errors='coerce'), pd.to_numeric(lon, errors='coerce')
+    if source.get('negate_lon'):
+        lon = -lon
+
+    df = pd.DataFrame({
+        'ID': source['prefix'] + page[source['key']].astype(str),
+        'city': source['city'],
+        'year': parse_year(page[source['date_column']], source['year_format']),
+        'latitude': lat,
+        'longitude': lon
+    }, index=page.index)
+    if source.get('text_column'):
+        df['request_type'] = page[source['text_column']]
+
+    # remove null island, missing values and anything out of bounds
+    keep = (df.latitude != 0) & (df.longitude != 0) & \
+        df[['year', 'latitude', 'longitude']].notna().all(axis=1)
+    if source.get('bounds'):
+        min_lon, max_lon, min_lat, max_lat = source['bounds']
+        keep &= df.longitude.between(min_lon, max_lon) & df.latitude.between(min_lat, max_lat)
+
+    return df[keep].astype({'year': int})
+
+def clean_source(source: dict, loc: str, chunksize: int = CHUNK_SIZE) -> pd.DataFrame:
+    '''
+    Read the raw download of a source config at loc a chunk at a time and
+    clean each chunk with clean_page, so the raw file is never fully in memory.
+    '''
+    print(f'Cleaning {loc}')
+    chunks = read_raw(loc, chunksize=chunksize)
+    return collect_pages((clean_page(chunk, source) for chunk in chunks))
+
+def clean_sources(sources: dict, save_loc: str, n_workers: int = N_PROCESSES) -> pd.DataFrame:
+    '''
+    Clean every source in a registry from its raw download in save_loc, several
+    sources at a time in separate processes, and stack them in registry order.
+    '''
+    locs = [f"{save_loc}/{source['file_name']}" for source in sources.values()]
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        cleaned = list(pool.map(clean_source, sources.values(), locs))
+
+    return pd.concat(cleaned, ignore_index=True)
 
 def to_decimal(dms: str) -> float:
     '''
@@ -194,23 +1048,140 @@ def to_decimal(dms: str) -> float:
     
     return round((float(deg) + float(minutes) / 60 + float(seconds) / 3600), 5)
 
+# "deg min:sec" coordinates, e.g. "39 57:10.1234"
+DMS_PATTERN = (r'^\s*(?P<deg>[-+]?\d+(?:\.\d*)?) +(?P<min>\d+(?:\.\d*)?)'
+               r':(?P<sec>\d+(?:\.\d*)?)\s*$')
+
+# Dekker's splitting constant, for exact products of doubles
+SPLITTER = 2.0 ** 27 + 1
+
+def _split(x: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    c = SPLITTER * x
+    hi = c - (c - x)
+    return hi, x - hi
+
+def round_exact(x: np.ndarray, digits: int) -> np.ndarray:
+    '''
+    Round an array exactly like python's round(x, digits) rounds each value.
+    numpy's round works on x * 10**digits, whose rounding error can land it
+    on the other side of a tie. Here that error is recovered exactly
+    (Dekker's two product), so the tie is decided on the exact product,
+    half to even.
+    '''
+    scale = 10.0 ** digits
+    product = x * scale
+    x_hi, x_lo = _split(x)
+    s_hi, s_lo = _split(scale)
+    error = ((x_hi * s_hi - product) + x_hi * s_lo + x_lo * s_hi) + x_lo * s_lo
+
+    whole = np.floor(product)
+    above_half = (product - (whole + 0.5)) + error
+    whole = np.where(above_half > 0, whole + 1,
+                     np.where(above_half < 0, whole, whole + (whole % 2 == 1)))
+    return whole / scale
+
+def _dms_fields(values: pd.Series) -> list[np.ndarray]:
+    '''
+    Degree, minute and second arrays of "deg min:sec" strings, NaN where an
+    entry doesn't match. The regex runs in arrow's C++ kernels, and the
+    string to float casts there are exact, like float().
+    '''
+    fields = pc.extract_regex(pa.array(values.astype(str)), DMS_PATTERN)
+    return [pc.cast(pc.struct_field(fields, name), pa.float64()).to_numpy(zero_copy_only=False)
+            for name in ['deg', 'min', 'sec']]
+
+def dms_to_decimal(values: pd.Series) -> pd.Series:
+    '''
+    Convert a whole column of degree minute:seconds coordinates to decimals
+    at once. Gives the same numbers as to_decimal, but malformed or missing
+    entries come out as NaN instead of raising.
+    '''
+    if len(values) == 0:
+        return pd.Series(dtype=float, index=values.index)
+
+    degrees, minutes, seconds = _dms_fields(values)
+    decimal = degrees + minutes / 60 + seconds / 3600
+    return pd.Series(round_exact(decimal, 5), index=values.index)
+
+def term_pattern(terms: list[str]) -> str:
+    '''
+    Compile a list of terms into one regex matching any of them literally.
+    '''
+    return '|'.join(re.escape(term) for term in terms)
+
+def _lowered_uniques(values: pd.Series) -> tuple[np.ndarray, pd.Series, pd.Series]:
+    '''
+    Factorize values and return (codes, lowered uniques, lowered missing values).
+    Columns like request types have a handful of distinct values across
+    millions of rows, so we only ever lower and search the distinct ones.
+    Missing values get code -1 and are kept separately, since str() tells
+    None and NaN apart.
+    '''
+    codes, uniques = pd.factorize(values)
+    lowered = pd.Series(uniques, dtype=object).astype(str).str.lower()
+    missing = values[codes == -1].astype(str).str.lower()
+    return codes, lowered, missing
+
+def text_matches(values: pd.Series, relevant_terms: list[str]) -> pd.Series:
+    '''
+    Return a boolean mask of which values contain any of relevant_terms once
+    converted to lower case strings. Terms are matched as given, exactly like
+    the old per row loop did.
+    '''
+    if len(relevant_terms) == 0:
+        return pd.Series(False, index=values.index)
+
+    pattern = term_pattern(relevant_terms)
+    codes, lowered, missing = _lowered_uniques(values)
+
+    hits = lowered.str.contains(pattern, regex=True).to_numpy(dtype=bool)
+    mask = np.zeros(len(values), dtype=bool)
+    mask[codes != -1] = hits[codes[codes != -1]]
+    mask[codes == -1] = missing.str.contains(pattern, regex=True).to_numpy(dtype=bool)
+
+    return pd.Series(mask, index=values.index)
+
+def categorize(values: pd.Series, categories: dict[str, list[str]]) -> np.ndarray:
+    '''
+    Return, for each value, the position of the first category in categories
+    (a dict of category name to its terms) with a term the lower cased value
+    contains, or -1 if none match.
+    '''
+    codes, lowered, missing = _lowered_uniques(values)
+    unique_cats = np.full(len(lowered), -1, dtype=np.int8)
+    missing_cats = np.full(len(missing), -1, dtype=np.int8)
+
+    # Go backwards so earlier categories overwrite later ones
+    for i, terms in reversed(list(enumerate(categories.values()))):
+        pattern = term_pattern(terms)
+        unique_cats[lowered.str.contains(pattern, regex=True).to_numpy(dtype=bool)] = i
+        missing_cats[missing.str.contains(pattern, regex=True).to_numpy(dtype=bool)] = i
+
+    cats = np.full(len(values), -1, dtype=np.int8)
+    cats[codes != -1] = unique_cats[codes[codes != -1]]
+    cats[codes == -1] = missing_cats
+    return cats
+
+def count_terms(df: pd.DataFrame, col: str, relevant_terms: list[str]) -> pd.Series:
+    '''
+    Count how many rows of df mention each of relevant_terms in the col
+    column. A row mentioning two terms counts towards both.
+    '''
+    codes, lowered, missing = _lowered_uniques(df[col])
+    n_per_unique = np.bincount(codes[codes != -1], minlength=len(lowered))
+
+    counts = {}
+    for term in relevant_terms:
+        hits = lowered.str.contains(term, regex=False).to_numpy(dtype=bool)
+        counts[term] = int(n_per_unique[hits].sum()) + \
+            int(missing.str.contains(term, regex=False).sum())
+
+    return pd.Series(counts, name='n_rows')
+
 def filter_text_col(df: pd.DataFrame, col: str, relevant_terms: list[str]) -> pd.DataFrame:
     '''
     Given a dataframe df, a column name col, and a list of relevant terms to appear
     in that column, subsets the dataframe to only contain rows with the relevant
     terms in the col column.
     '''
-
-    def is_relevant(s):
-        '''
-        Return whether s is relevant or irrelevant
-        '''
-        for val in relevant_terms:
-            if val in str(s).lower():
-                return True
-        return False
-
-    mask = df[col].apply(lambda x: is_relevant(x))
-
-    return df[mask]
-        
+    return df[text_matches(df[col], relevant_terms).to_numpy()]
@@ -0,0 +1,235 @@
+### About: Runs the python half of the pipeline in the right order, skipping
+### whatever is already up to date. Every stage declares the code it runs on,
+### the files it reads and the files it writes. A stage reruns when the hash
+### of its code and inputs differs from its last successful run, or when any
+### of its outputs are missing, and stages that don't depend on each other
+### run at the same time.
+###
+### Run from the scripts folder:
+###   python pipeline.py                 # bring everything up to date
+###   python pipeline.py --force STAGE   # rerun STAGE (and so what's after it); repeatable
+###   python pipeline.py --refresh       # pass --refresh on to the ingestion stages
+###   python pipeline.py --dry-run       # only say what would run
+### get_census.R (which makes cens1940shapes.shp) still has to be run by hand.
+
+import os
+import sys
+import json
+import argparse
+import hashlib
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import point_store as ps
+import storage_helpers as stg
+from attach_crashes_cities import COUNT_CUBE_LOC
+
+STATE_LOC = '../data/pipeline_state.json'
+
+# Modules the ingestion stages import; a change to any of them reruns the stage
+INGEST_CODE = ['sources.py', 'city_helpers.py', 'storage_helpers.py', 'point_store.py']
+SPATIAL_CODE = ['spatial_helpers.py', 'storage_helpers.py', 'point_store.py']
+
+STAGES = {
+    '311_data': {
+        'script': '311_data.py',
+        'code': INGEST_CODE,
+        'inputs': [],
+        'outputs': [stg.REQUEST_POINTS_LOC, ps.REQUEST_STORE_LOC],
+        'after': [],
+        'refreshable': True,
+    },
+    'crash_data': {
+        'script': 'crash_data.py',
+        'code': INGEST_CODE,
+        'inputs': [],
+        'outputs': [stg.CRASH_POINTS_LOC, ps.CRASH_STORE_LOC],
+        'after': [],
+        'refreshable': True,
+    },
+    'attach_crashes_cities': {
+        'script': 'attach_crashes_cities.py',
+        'code': [*SPATIAL_CODE, 'sources.py'],
+        'inputs': ['../data/shapes/cens1940shapes.shp', '../data/shapes/cens1940shapes.dbf',
+                   '../data/shapes/cens1940shapes.prj', ps.CRASH_STORE_LOC, ps.REQUEST_STORE_LOC],
+        'outputs': [stg.CENS_CRASHES_LOC, stg.CENSUS_FINAL_LOC, COUNT_CUBE_LOC],
+        'after': ['311_data', 'crash_data'],
+    },
+    'fix_final_data': {
+        'script': 'fix_final_data.py',
+        'code': [*SPATIAL_CODE, 'treatment_helpers.py'],
+        'inputs': ['../data/shapes/ad_data.json', '../data/shapes/mappinginequality.gpkg',
+                   stg.CENSUS_FINAL_LOC],
+        'outputs': [stg.CENSUS_FINAL_FIXED_LOC, '../data/shapes/census_final_fixed.shp'],
+        'after': ['attach_crashes_cities'],
+    },
+}
+
+def read_state(loc: str = STATE_LOC) -> dict:
+    '''
+    Read the stage and file hashes of previous runs.
+    '''
+    if not os.path.exists(loc):
+        return {'stages': {}, 'files': {}}
+    with open(loc) as f:
+        return json.load(f)
+
+def write_state(state: dict, loc: str = STATE_LOC) -> None:
+    with open(f'{loc}.part', 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(f'{loc}.part', loc)
+
+def file_hash(path: str, known: dict) -> str:
+    '''
+    sha256 of a file's contents. Hashes are remembered in known by size and
+    modification time, so big unchanged files are only ever read once.
+    '''
+    stat = os.stat(path)
+    if path in known and known[path][:2] == [stat.st_size, stat.st_mtime_ns]:
+        return known[path][2]
+
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+
+    known[path] = [stat.st_size, stat.st_mtime_ns, h.hexdigest()]
+    return h.hexdigest()
+
+def path_hash(path: str, known: dict) -> str:
+    '''
+    Hash a file, or every file under a folder along with its relative path.
+    Missing paths hash to 'missing'.
+    '''
+    if os.path.isfile(path):
+        return file_hash(path, known)
+    if not os.path.isdir(path):
+        return 'missing'
+
+    h = hashlib.sha256()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            full = os.path.join(root, name)
+            h.update(os.path.relpath(full, path).encode())
+            h.update(file_hash(full, known).encode())
+    return h.hexdigest()
+
+def stage_hash(stage: dict, known: dict) -> str:
+    '''
+    Hash everything a stage's results depend on: its script, the code it
+    imports and its inputs.
+    '''
+    h = hashlib.sha256()
+    for path in [stage['script'], *stage['code'], *stage['inputs']]:
+        h.update(path.encode())
+        h.update(path_hash(path, known).encode())
+    return h.hexdigest()
+
+def needs_run(name: str, state: dict, forced: set[str]) -> tuple[bool, str]:
+    '''
+    Return whether a stage has to run, and why.
+    '''
+    stage = STAGES[name]
+    if name in forced:
+        return True, 'forced'
+    if any(not os.path.exists(out) for out in stage['outputs']):
+        return True, 'missing outputs'
+    if state['stages'].get(name) != stage_hash(stage, state['files']):
+        return True, 'code or inputs changed'
+    return False, 'up to date'
+
+def run_stage(name: str, refresh: bool) -> int:
+    '''
+    Run one stage's script in its own process and return its exit code.
+    '''
+    stage = STAGES[name]
+    args = [sys.executable, stage['script']]
+    if refresh and stage.get('refreshable'):
+        args.append('--refresh')
+
+    print(f'[{name}] running {" ".join(args[1:])}')
+    return subprocess.run(args).returncode
+
+def downstream(names: set[str]) -> set[str]:
+    '''
+    Every stage that (eventually) runs after any of names, and names themselves.
+    '''
+    found = set(names)
+    while True:
+        more = {name for name, stage in STAGES.items()
+                if name not in found and found.intersection(stage['after'])}
+        if not more:
+            return found
+        found |= more
+
+def run_pipeline(forced: set[str] = set(), refresh: bool = False, dry_run: bool = False,
+                 max_parallel: int = len(STAGES)) -> bool:
+    '''
+    Bring every stage up to date, running each as soon as the stages before
+    it are done. A stage's hash is taken just before it would run, so
+    anything an upstream stage rewrote is seen. Stops scheduling after a
+    failure and returns whether everything succeeded.
+    '''
+    state = read_state()
+    forced = downstream(forced)
+    if refresh:
+        forced = downstream(forced | {name for name, stage in STAGES.items()
+                                      if stage.get('refreshable')})
+
+    done, failed, running = set(), set(), {}
+    with ThreadPoolExecutor(max_workers=max_parallel) as pool:
+        while True:
+            for name, stage in STAGES.items():
+                if name in done or name in failed or name in running.values():
+                    continue
+                if not set(stage['after']) <= done:
+                    continue
+
+                run, reason = needs_run(name, state, forced)
+                print(f'[{name}] {reason}')
+                if run and dry_run:
+                    # Whatever comes after would see new inputs
+                    forced = downstream(forced | {name})
+                if not run or dry_run:
+                    done.add(name)
+                    continue
+                running[pool.submit(run_stage, name, refresh)] = name
+
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                if future.result() != 0:
+                    print(f'[{name}] failed, not running anything after it.')
+                    failed.add(name)
+                    continue
+                state['stages'][name] = stage_hash(STAGES[name], state['files'])
+                write_state(state)
+                done.add(name)
+
+            if failed:
+                # Let what's already running finish, but start nothing new
+                for future in wait(running).done:
+                    name = running.pop(future)
+                    if future.result() == 0:
+                        state['stages'][name] = stage_hash(STAGES[name], state['files'])
+                        write_state(state)
+                break
+
+    return not failed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Bring the python half of the pipeline up to date.')
+    parser.add_argument('--force', action='append', default=[], choices=list(STAGES),
+                        metavar='STAGE', help='rerun STAGE (and so what comes after it); '
+                        f'repeatable. Stages are {", ".join(STAGES)}')
+    parser.add_argument('--refresh', action='store_true',
+                        help='pass --refresh on to the ingestion stages')
+    parser.add_argument('--dry-run', action='store_true', help='only say what would run')
+    args = parser.parse_args()
+
+    ok = run_pipeline(set(args.force), refresh=args.refresh, dry_run=args.dry_run)
+    sys.exit(0 if ok else 1)
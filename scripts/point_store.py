@@ -0,0 +1,150 @@
+### About: A compact, memory-mapped store for the unified crash and 311 point
+### tables. Every column is a flat .npy array in one folder, so any number of
+### processes can np.load(..., mmap_mode='r') the same files and share one
+### copy through the page cache, instead of pickling big frames to each other.
+###
+### Layout of a store folder:
+###   lon.npy, lat.npy   float64 coordinates
+###   year.npy           int16
+###   city.npy           uint8 position in meta['cities']
+###   category.npy       uint8 position in meta['categories'], NO_CATEGORY if none
+###   id.npy             int64 record id, without the city prefix
+###   ids_<n>.npy        id strings of city n, if its ids aren't plain integers
+###   meta.json          schema version, labels for the codes above, the row count
+###                      and a hash of the coordinates
+
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
+
+CRASH_STORE_LOC = '../data/crashes/crash_store'
+REQUEST_STORE_LOC = '../data/311/request_store'
+
+# Bump whenever the layout or the cleaning rules behind a store change, so
+# stale stores get rebuilt instead of silently read
+SCHEMA_VERSION = 2
+
+NO_CATEGORY = 255
+
+STORE_DTYPES = {
+    'lon': np.float64,
+    'lat': np.float64,
+    'year': np.int16,
+    'city': np.uint8,
+    'category': np.uint8,
+    'id': np.int64,
+}
+
+# Ids that round trip through an int64: no leading zeros, at most 18 digits
+INTEGER_ID_PATTERN = r'(?:0|[1-9]\d{0,17})'
+
+def encode_ids(suffixes: pd.Series) -> tuple[np.ndarray, np.ndarray | None]:
+    '''
+    Turn a city's ids (prefix already stripped) into int64s. Plain integer ids
+    are stored as themselves; anything else is factorized, and the strings
+    table to decode the codes with is returned alongside.
+    '''
+    suffixes = suffixes.astype(str)
+    if suffixes.str.fullmatch(INTEGER_ID_PATTERN).all():
+        return suffixes.astype(np.int64).to_numpy(), None
+
+    codes, uniques = pd.factorize(suffixes)
+    return codes.astype(np.int64), np.asarray(uniques, dtype=str)
+
+def write_point_store(df: pd.DataFrame, path: str, prefixes: dict[str, str],
+                      categories: list[str], category_codes: np.ndarray) -> None:
+    '''
+    Write the cleaned points in df (CLEAN_COLUMNS) to a store folder at path,
+    replacing whatever was there.
+
+    Inputs:
+        prefixes: the ID prefix of each city, e.g. {'NYC': 'NY'}
+        categories: category labels
+        category_codes: each row's position in categories, or -1 for none
+    '''
+    if len(categories) >= NO_CATEGORY:
+        raise ValueError(f'A point store holds at most {NO_CATEGORY} categories')
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+
+    city_codes, cities = pd.factorize(df.city)
+    ids = np.zeros(len(df), dtype=np.int64)
+    id_tables = {}
+    for code, city in enumerate(cities):
+        rows = city_codes == code
+        suffixes = df.ID[rows].astype(str).str[len(prefixes[city]):]
+        ids[rows], table = encode_ids(suffixes)
+        if table is not None:
+            id_tables[city] = f'ids_{code}.npy'
+            np.save(os.path.join(path, id_tables[city]), table)
+
+    category_codes = np.asarray(category_codes)
+    columns = {
+        'lon': df.longitude.to_numpy(),
+        'lat': df.latitude.to_numpy(),
+        'year': df.year.to_numpy(),
+        'city': city_codes,
+        'category': np.where(category_codes >= 0, category_codes, NO_CATEGORY),
+        'id': ids,
+    }
+    coords_sha256 = hashlib.sha256()
+    for name, values in columns.items():
+        values = np.asarray(values, dtype=STORE_DTYPES[name])
+        np.save(os.path.join(path, f'{name}.npy'), values)
+        if name in ('lon', 'lat'):
+            coords_sha256.update(values.tobytes())
+
+    meta = {
+        'schema_version': SCHEMA_VERSION,
+        'n_rows': len(df),
+        # Lets caches of anything derived from the coordinates tell when
+        # the store has been rewritten with different points
+        'coords_sha256': coords_sha256.hexdigest(),
+        'cities': list(cities),
+        'prefixes': [prefixes[city] for city in cities],
+        'categories': list(categories),
+        'id_tables': id_tables,
+    }
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+
+def open_point_store(path: str) -> dict:
+    '''
+    Map a store folder read only. Returns a dict of its arrays, which are
+    np.memmaps (nothing is read until it's touched), plus its 'meta' and 'path'.
+    Raises a ValueError for stores written under another SCHEMA_VERSION.
+    '''
+    with open(os.path.join(path, 'meta.json')) as f:
+        store = {'meta': json.load(f), 'path': path}
+
+    version = store['meta'].get('schema_version')
+    if version != SCHEMA_VERSION:
+        raise ValueError(f'{path} has schema version {version}, expected {SCHEMA_VERSION}. '
+                         'Rerun the script that writes it (crash_data.py or 311_data.py).')
+
+    for name in STORE_DTYPES:
+        store[name] = np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+    return store
+
+def point_ids(store: dict, rows: np.ndarray = slice(None)) -> pd.Series:
+    '''
+    Rebuild the prefixed string IDs (e.g. 'NY12345') of the given rows.
+    '''
+    meta = store['meta']
+    city, ids = np.asarray(store['city'][rows]), np.asarray(store['id'][rows])
+    out = np.empty(len(ids), dtype=object)
+
+    for code, (name, prefix) in enumerate(zip(meta['cities'], meta['prefixes'])):
+        mask = city == code
+        suffixes = ids[mask].astype(str)
+        if name in meta['id_tables']:
+            table = np.load(os.path.join(store['path'], meta['id_tables'][name]))
+            suffixes = table[ids[mask]]
+        out[mask] = np.char.add(prefix, suffixes.astype(str))
+
+    return pd.Series(out, name='ID')
@@ -0,0 +1,273 @@
+### About: Every dataset we pull, described in one place. Each entry says where
+### the data lives and how to page through it, and how to turn its rows into
+### our standard ID, city, year, latitude, longitude columns. Adding a city
+### should only ever mean adding entries here.
+###
+### Fetching keys (see city_helpers.iter_source_pages):
+###   style: 'soda', 'soda_la', 'arcgis' or 'carto'
+###   url, params, offset_param: the endpoint and its default query
+###   columns: columns to request and keep
+###   key: record id column, used to deduplicate and merge refreshes
+###   date_column: column used as the high water mark for --refresh
+###   window: optional where clause limiting full downloads to the study period
+###   window_end: the last date_column value inside window, in the format the
+###     high water marks take (see city_helpers.date_clause). --refresh only
+###     asks for rows between what we have and window_end.
+###   text_column, terms: optional server side (and local) term filter
+###   file_name: where the raw download goes in the save folder
+### Cleaning keys (see city_helpers.clean_page):
+###   city, prefix: city name and the prefix to put on its IDs
+###   year_format: 'iso' (year is the first 4 characters), 'int' or 'epoch_ms'
+###   lat_column, lon_column: where the coordinates are
+###   coord_format: 'decimal' or 'dms' (PennDOT "deg min:sec" strings)
+###   negate_lon: flip the longitude sign, for west-positive data
+###   bounds: optional (min lon, max lon, min lat, max lat) box to keep
+
+# 311 request types we care about
+RELEVANT_TERMS = ['streetlight', 'street light', 'dumping', 'graffiti']
+
+# How 311s are split up in the tract count cube: category -> terms. A request
+# goes in the first category it matches.
+REQUEST_CATEGORIES = {
+    'streetlight': ['streetlight', 'street light'],
+    'dumping': ['dumping'],
+    'graffiti': ['graffiti'],
+}
+
+# Axes of the tract x year x category count cube
+STUDY_YEARS = list(range(2018, 2023))
+COUNT_CATEGORIES = ['crash', *REQUEST_CATEGORIES]
+
+CRASH_SAVE_LOC = '../data/crashes/unjoined'
+REQUEST_SAVE_LOC = '../data/311/unjoined'
+
+CITIES = {
+    'la': {'city': 'Los Angeles', 'prefix': 'LA'},
+    'chicago': {'city': 'Chicago', 'prefix': 'CH'},
+    'nyc': {'city': 'NYC', 'prefix': 'NY', 'bounds': (-75, -72, 40, 42)},
+    'detroit': {'city': 'Detroit', 'prefix': 'DT'},
+    'phili': {'city': 'Philadelphia', 'prefix': 'PH'},
+}
+
+CRASH_SOURCES = {
+    'la': {
+        **CITIES['la'],
+        'style': 'soda_la',
+        'url':'https://data.lacity.org/resource/d5tf-ez2w.json',
+        'params': {
+            "$limit": 50000,
+            "$order": "date_occ DESC, :id"  # :id breaks ties, so pages are stable
+        },
+        'offset_param': '$offset',
+        'columns': ['dr_no', 'date_occ', 'crm_cd_desc', 'latitude', 'longitude'],
+        'key': 'dr_no',
+        'date_column': 'date_occ',
+        'window': "date_occ between '2018-01-01T00:00:00' and '2022-12-31T23:59:59'",
+        'window_end': '2022-12-31T23:59:59',
+        'year_format': 'iso',
+        'lat_column': 'latitude',
+        'lon_column': 'longitude',
+        'file_name': 'la_crashes_18_22.jsonl'
+    },
+    'chicago': {
+        **CITIES['chicago'],
+        'style': 'soda',
+        'url': "https://data.cityofchicago.org/resource/85ca-t3if.json",
+        'params' : {
+            "$limit": 50000,  # Max records per request
+            "$order": "crash_date DESC, :id"
+        },
+        'offset_param': '$offset',
+        'columns': ['crash_record_id', 'crash_date', 'injuries_total', 'latitude', 'longitude'],
+        'key': 'crash_record_id',
+        'date_column': 'crash_date',
+        'window': "crash_date between '2018-01-01T00:00:00' and '2022-12-31T23:59:59'",
+        'window_end': '2022-12-31T23:59:59',
+        'year_format': 'iso',
+        'lat_column': 'latitude',
+        'lon_column': 'longitude',
+        'file_name': 'chicago_crashes_18_22.jsonl'
+    },
+    'nyc': {
+        **CITIES['nyc'],
+        'style': 'soda',
+        'url': 'https://data.cityofnewyork.us/resource/h9gi-nx95.json',
+        'params': {
+            "$limit": 50000,
+            "$order": "crash_date DESC, :id"
+        },
+        'offset_param': '$offset',
+        'columns': ['crash_date', 'latitude', 'longitude', 'number_of_persons_killed', 'collision_id'],
+        'key': 'collision_id',
+        'date_column': 'crash_date',
+        'window': "crash_date between '2018-01-01T00:00:00' and '2022-12-31T23:59:59'",
+        'window_end': '2022-12-31T23:59:59',
+        'year_format': 'iso',
+        'lat_column': 'latitude',
+        'lon_column': 'longitude',
+        'file_name': 'nyc_crashes_18_22.jsonl'
+    },
+    'phili': {
+        **CITIES['phili'],
+        'style': 'arcgis',
+        'url': 'https://services.arcgis.com/fLeGjb7u4uXqeF9q/arcgis/rest/services/collision_crash_2018_2022/FeatureServer/0/query?',
+        'params': {
+            'outFields':"crash_year,crn,longitude,latitude",
+            'f':'json',
+            'resultRecordCount':2000,
+            'resultOffset':0
+        },
+        'columns':['crash_year','crn','longitude','latitude'],
+        'offset_param': 'resultOffset',
+        'key': 'crn',
+        'date_column': 'crash_year',
+        'window': 'crash_year>=2018 AND crash_year<=2022',
+        'window_end': 2022,
+        'year_format': 'int',
+        'lat_column': 'latitude',
+        'lon_column': 'longitude',
+        'coord_format': 'dms',
+        'negate_lon': True,
+        # Keeps out a weird entry that lands on longitude -74
+        'bounds': (-75.5, -74.5, 39.5, 40.5),
+        'file_name': 'phili_crashes_18_22.jsonl'
+    },
+}
+
+# Detroit publishes one crash layer per year
+for year, layer in zip(range(2018, 2023), range(8, 13)):
+    CRASH_SOURCES[f'detroit{year % 100}'] = {
+        **CITIES['detroit'],
+        'style': 'arcgis',
+        'url': f'https://services2.arcgis.com/qvkbeam7Wirps6zC/arcgis/rest/services/Traffic_Crashes/FeatureServer/{layer}/query?',
+        'params': {
+            "outFields": "crash_id,crash_date,latitude,longitude,num_fatal_injuries,year",
+            "f": "json",  # Response format
+            "resultRecordCount": 50000,  # Number of records per request
+            "resultOffset": 0  # Offset for pagination
+        },
+        'columns': ['crash_id', 'year', 'latitude', 'longitude'],
+        'offset_param': 'resultOffset',
+        'key': 'crash_id',
+        'date_column': 'year',
+        'window': "year >= 2018 AND year <= 2022",
+        'window_end': 2022,
+        'year_format': 'int',
+        'lat_column': 'latitude',
+        'lon_column': 'longitude',
+        'file_name': f'detroit_crashes_{year % 100}.jsonl'
+    }
+
+REQUEST_SOURCES = {}
+
+# LA publishes one 311 dataset per year
+for year, resource in zip(range(2018, 2023), ['h65r-yf5i', 'pvft-t768', 'rq3b-xjk8', '97z7-y5bt', 'i5ke-k6by']):
+    REQUEST_SOURCES[f'la_{year}'] = {
+        **CITIES['la'],
+        'style': 'soda',
+        'url': f'https://data.lacity.org/resource/{resource}.json',
+        'params' :{
+            '$limit': 50000,
+            '$order': 'CreatedDate DESC, :id'
+        },
+        'offset_param': '$offset',
+        'columns': ['srnumber', 'requesttype', 'createddate', 'latitude', "longitude"],
+        'key': 'srnumber',
+        'text_column': 'requesttype',
+        'terms': RELEVANT_TERMS,
+        'date_column': 'createddate',
+        'year_format': 'iso',
+        'lat_column': 'latitude',
+        'lon_column': 'longitude',
+        'file_name': f'la_311_{year % 100}.jsonl'
+    }
+
+REQUEST_SOURCES.update({
+    'chicago': {
+        **CITIES['chicago'],
+        'style': 'soda',
+        'url': 'https://data.cityofchicago.org/resource/v6vf-nfxy.json',
+        'params': {
+            '$limit': 50000,
+            "$order": ":id"  # Stable order so pages don't shift under us
+        },
+        'offset_param': '$offset',
+        'columns': ['sr_number', 'sr_type', 'created_date', 'latitude', "longitude"],
+        'key': 'sr_number',
+        'text_column': 'sr_type',
+        'terms': RELEVANT_TERMS,
+        'date_column': 'created_date',
+        'window': "created_date between '2018-01-01T00:00:00' and '2022-12-31T23:59:59'",
+        'window_end': '2022-12-31T23:59:59',
+        'year_format': 'iso',
+        'lat_column': 'latitude',
+        'lon_column': 'longitude',
+        'file_name': 'chicago_311_18_22.jsonl'
+    },
+    'nyc': {
+        **CITIES['nyc'],
+        'style': 'soda',
+        'url': 'https://data.cityofnewyork.us/resource/erm2-nwe9.json',
+        'params': {
+            '$limit': 50000,
+            "$order": ":id"  # Stable order so pages don't shift under us
+        },
+        'offset_param': '$offset',
+        'columns': ['unique_key', 'complaint_type', 'created_date', 'latitude', "longitude"],
+        'key': 'unique_key',
+        'text_column': 'complaint_type',
+        'terms': RELEVANT_TERMS,
+        'date_column': 'created_date',
+        'window': "created_date between '2018-01-01T00:00:00' and '2022-12-31T23:59:59'",
+        'window_end': '2022-12-31T23:59:59',
+        'year_format': 'iso',
+        'lat_column': 'latitude',
+        'lon_column': 'longitude',
+        'file_name': 'nyc_311_18_22.jsonl'
+    },
+    'phili': {
+        **CITIES['phili'],
+        'style': 'carto',
+        'url': 'https://phl.carto.com/api/v2/sql',
+        'params': {
+            'table': 'public_cases_fc',
+            'limit': 50000
+        },
+        'offset_param': 'offset',
+        'columns': ['service_request_id', 'subject', 'requested_datetime', 'lat', 'lon'],
+        'key': 'service_request_id',
+        'text_column': 'subject',
+        'terms': RELEVANT_TERMS,
+        'date_column': 'requested_datetime',
+        'window': "requested_datetime >= '2018-01-01' AND requested_datetime <= '2022-12-31'",
+        'window_end': '2022-12-31',
+        'year_format': 'iso',
+        'lat_column': 'lat',
+        'lon_column': 'lon',
+        'file_name': 'phili_311_18_22.jsonl'
+    },
+    'detroit': {
+        **CITIES['detroit'],
+        'style': 'arcgis',
+        'url': 'https://services2.arcgis.com/qvkbeam7Wirps6zC/arcgis/rest/services/Improve_Detroit_Issues_Test/FeatureServer/0/query?',
+        'params': {
+            "outFields": "ID, Request_Type_Title,Latitude,Longitude,Created_At",
+            "f": "json",  # Response format
+            "resultRecordCount": 50000,  # Number of records per request
+            "resultOffset": 0  # Offset for pagination
+        },
+        'columns': ['ID', 'Request_Type_Title', 'Created_At', 'Latitude', 'Longitude'],
+        'offset_param': 'resultOffset',
+        'key': 'ID',
+        'text_column': 'Request_Type_Title',
+        'terms': RELEVANT_TERMS,
+        'date_column': 'Created_At',
+        'window': "Created_At >= DATE '2018-01-01' AND Created_At < DATE '2023-01-01'",
+        'window_end': '2022-12-31 23:59:59',
+        'year_format': 'epoch_ms',
+        'lat_column': 'Latitude',
+        'lon_column': 'Longitude',
+        'paranoid': True,
+        'file_name': 'detroit_311_18_22.jsonl'
+    },
+})
@@ -0,0 +1,361 @@
+### About: Helpers for assigning points (crashes, 311s) to census tracts
+### without building a GeoDataFrame or a spatial join per point layer.
+
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import islice
+from pyproj import Transformer
+from typing import Iterator
+
+import point_store as ps
+
+# The equal area CRS our 1940 tracts are stored in
+TRACT_CRS = 'ESRI:102003'
+
+# Defaults for the out of core join: points per chunk and worker processes
+CHUNK_SIZE = 1_000_000
+N_WORKERS = os.cpu_count() or 1
+
+@lru_cache(maxsize=None)
+def transformer(from_crs: str, to_crs: str) -> Transformer:
+    '''
+    Build (once per pair of CRSs) a lon/lat ordered transformer.
+    '''
+    return Transformer.from_crs(from_crs, to_crs, always_xy=True)
+
+def coords_hash(x: np.ndarray, y: np.ndarray) -> str:
+    '''
+    Hash a pair of coordinate arrays, so we can tell when we've seen them before.
+    '''
+    h = hashlib.sha256()
+    for values in (x, y):
+        h.update(np.ascontiguousarray(values, dtype=float).tobytes())
+    return h.hexdigest()
+
+def projection_path(cache_dir: str, digest: str, from_crs: str, to_crs: str) -> str:
+    '''
+    Where the projection of the coordinates with hash (or key) digest lives.
+    '''
+    # CRSs read off of files are often long WKT strings, so hash those too
+    crs_tag = hashlib.sha256(f'{from_crs}->{to_crs}'.encode()).hexdigest()[:12]
+    return os.path.join(cache_dir, f'{digest}_{crs_tag}.npy')
+
+def project_cached(x: np.ndarray, y: np.ndarray, to_crs: str, from_crs: str = 'EPSG:4326',
+                   cache_dir: str = None, key: str = None) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Project coordinate arrays from from_crs to to_crs in one vectorized call.
+    With a cache_dir, the projected coordinates are saved there keyed by a
+    hash of the input (or by key, if the caller already knows what the input
+    is) and the two CRSs, and later calls with the same input just load them.
+    '''
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    if cache_dir is None:
+        return transformer(from_crs, to_crs).transform(x, y)
+
+    digest = coords_hash(x, y) if key is None else key
+    path = projection_path(cache_dir, digest, from_crs, to_crs)
+    if os.path.exists(path):
+        projected = np.load(path)
+        return projected[0], projected[1]
+
+    projected = np.stack(transformer(from_crs, to_crs).transform(x, y))
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(f'{path}.part', 'wb') as f:
+        np.save(f, projected)
+    os.replace(f'{path}.part', path)
+    return projected[0], projected[1]
+
+def to_crs_cached(gdf: gpd.GeoDataFrame, crs: str, cache_dir: str = None) -> gpd.GeoDataFrame:
+    '''
+    gdf.to_crs(crs), but done by projecting every vertex at once through
+    project_cached, so the same shapes are only ever projected once.
+    '''
+    if gdf.crs is None:
+        raise ValueError('Cannot project a GeoDataFrame with no CRS')
+
+    geoms = np.asarray(gdf.geometry.array)
+    coords = shapely.get_coordinates(geoms)
+    x, y = project_cached(coords[:, 0], coords[:, 1], crs, gdf.crs.to_string(), cache_dir)
+    projected = shapely.set_coordinates(geoms.copy(), np.column_stack([x, y]))
+
+    out = gdf.copy()
+    out[gdf.geometry.name] = gpd.GeoSeries(projected, index=gdf.index, crs=crs)
+    return out.set_crs(crs, allow_override=True)
+
+class TractIndex:
+    '''
+    An STRtree over a set of tract polygons, built once and then bulk queried
+    with arrays of point coordinates. Any number of point layers can share it.
+
+    Points are matched to tracts with the 'intersects' predicate, the same as
+    gpd.sjoin's default, so points on a shared boundary count for both tracts.
+    '''
+
+    def __init__(self, tracts: gpd.GeoDataFrame, crs: str = TRACT_CRS, cache_dir: str = None):
+        self.tracts = tracts
+        self.crs = crs
+        self.cache_dir = cache_dir
+        self.geoms = np.asarray(tracts.geometry.array)
+        self.tree = shapely.STRtree(self.geoms)
+
+    def __len__(self) -> int:
+        return len(self.geoms)
+
+    def project(self, lon: np.ndarray, lat: np.ndarray, from_crs: str = 'EPSG:4326',
+                key: str = None) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        Project arrays of longitudes and latitudes into the tracts' CRS,
+        through the projection cache (under key, if given) if the index has
+        a cache_dir.
+        '''
+        return project_cached(lon, lat, self.crs, from_crs, self.cache_dir, key)
+
+    def query(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        '''
+        Return a (2, n_hits) array of (point position, tract position) pairs
+        for projected point coordinates x, y.
+        '''
+        points = shapely.points(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+        return self.tree.query(points, predicate='intersects')
+
+    def assign(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        '''
+        Return the position of the tract each projected point falls in as a
+        compact int32 array, with -1 for points in no tract. A point in
+        several (overlapping) tracts gets the first one.
+        '''
+        point_idx, tract_idx = self.query(x, y)
+        order = np.lexsort((tract_idx, point_idx))
+        point_idx, tract_idx = point_idx[order], tract_idx[order]
+        first = np.unique(point_idx, return_index=True)[1]
+
+        assigned = np.full(len(x), -1, dtype=np.int32)
+        assigned[point_idx[first]] = tract_idx[first]
+        return assigned
+
+    def count(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+        '''
+        Count the projected points in each tract, in tract order. A point in
+        several tracts counts for each of them, exactly like grouping the
+        output of gpd.sjoin by index_right.
+        '''
+        tract_idx = self.query(x, y)[1]
+        return np.bincount(tract_idx, minlength=len(self))
+
+    def count_by(self, x: np.ndarray, y: np.ndarray, year_idx: np.ndarray,
+                 category_idx: np.ndarray, n_years: int,
+                 n_categories: int) -> tuple[np.ndarray, np.ndarray]:
+        '''
+        Count projected points into tracts both in total and broken down by
+        year and category, off a single tree query. year_idx and category_idx
+        give each point's position on the year and category axes, or -1 to
+        leave it out of the breakdown (it still counts in the totals).
+
+        Returns (totals, cube) where cube has shape
+        (n_tracts, n_years, n_categories).
+        '''
+        point_idx, tract_idx = self.query(x, y)
+        totals = np.bincount(tract_idx, minlength=len(self))
+
+        year_idx = np.asarray(year_idx)[point_idx]
+        category_idx = np.asarray(category_idx)[point_idx]
+        keep = (year_idx >= 0) & (category_idx >= 0)
+        flat = (tract_idx[keep] * n_years + year_idx[keep]) * n_categories + category_idx[keep]
+
+        cube = np.bincount(flat, minlength=len(self) * n_years * n_categories)
+        return totals, cube.reshape(len(self), n_years, n_categories)
+
+    def count_lonlat(self, lon: np.ndarray, lat: np.ndarray,
+                     from_crs: str = 'EPSG:4326') -> np.ndarray:
+        '''
+        Project longitudes and latitudes and count them into tracts.
+        '''
+        return self.count(*self.project(lon, lat, from_crs))
+
+def counts_column(counts: np.ndarray, index: pd.Index, name: str) -> pd.Series:
+    '''
+    Turn per tract counts into a column to join onto the tracts. Tracts with
+    no points are left missing, as they were when we joined sjoin counts on.
+    '''
+    return pd.Series(counts, index=index, name=name).replace(0, np.nan)
+
+def overlay_matching(tracts: gpd.GeoDataFrame, areas: gpd.GeoDataFrame,
+                     left_on: str = 'grade', right_on: str = 'GRADE_HOLC') -> gpd.GeoDataFrame:
+    '''
+    The intersection overlay of tracts and (HOLC) areas, restricted to pairs
+    whose left_on and right_on columns match, like
+    tracts.overlay(areas) filtered on left_on == right_on, but without the
+    geometry work for everything the filter throws away.
+
+    Candidate pairs come from bounding box hits on an STRtree, so areas in
+    other cities are never looked at; pairs with different grades are then
+    dropped before any geometry is computed, and only the rest are
+    intersected, all in one vectorized call. Pairs that only share a
+    boundary are dropped, as overlay drops non polygon pieces.
+
+    The result has both layers' columns (clashing names get _1 and _2, like
+    overlay), the intersection as its geometry, and area_share, the part of
+    the tract's area the piece covers, for weighting partial overlaps.
+    '''
+    if tracts.crs != areas.crs:
+        raise ValueError(f'Layers are in different CRSs: {tracts.crs} and {areas.crs}')
+
+    tract_geoms = np.asarray(tracts.geometry.array)
+    area_geoms = np.asarray(areas.geometry.array)
+
+    # Bounding box hits only, no geometry yet
+    area_idx, tract_idx = shapely.STRtree(tract_geoms).query(area_geoms)
+
+    # Match grades the way pandas compares them (missing never matches)
+    left = tracts[left_on].iloc[tract_idx].reset_index(drop=True)
+    right = areas[right_on].iloc[area_idx].reset_index(drop=True)
+    same = (left == right).to_numpy(dtype=bool)
+    tract_idx, area_idx = tract_idx[same], area_idx[same]
+
+    pieces = shapely.intersection(tract_geoms[tract_idx], area_geoms[area_idx])
+    piece_areas = shapely.area(pieces)
+    overlaps = piece_areas > 0
+
+    order = np.lexsort((area_idx[overlaps], tract_idx[overlaps]))
+    tract_idx, area_idx = tract_idx[overlaps][order], area_idx[overlaps][order]
+    pieces, piece_areas = pieces[overlaps][order], piece_areas[overlaps][order]
+
+    left = tracts.drop(columns=tracts.geometry.name).iloc[tract_idx].reset_index(drop=True)
+    right = areas.drop(columns=areas.geometry.name).iloc[area_idx].reset_index(drop=True)
+    clashes = left.columns.intersection(right.columns)
+    left = left.rename(columns={col: f'{col}_1' for col in clashes})
+    right = right.rename(columns={col: f'{col}_2' for col in clashes})
+
+    out = pd.concat([left, right], axis=1)
+    out['area_share'] = piece_areas / shapely.area(tract_geoms[tract_idx])
+    return gpd.GeoDataFrame(out, geometry=pieces, crs=tracts.crs)
+
+def axis_positions(values: np.ndarray, labels: list) -> np.ndarray:
+    '''
+    Return each value's position in labels, or -1 if it isn't one of them.
+    '''
+    return pd.Index(labels).get_indexer(values)
+
+# Each worker process builds its own copy of the index once, from WKB
+_worker_index = None
+
+def _init_worker(wkb: np.ndarray, crs: str, cache_dir: str) -> None:
+    global _worker_index
+    geoms = gpd.GeoSeries(shapely.from_wkb(wkb))
+    _worker_index = TractIndex(gpd.GeoDataFrame(geometry=geoms), crs, cache_dir)
+
+def store_chunk_key(store: dict, start: int, stop: int) -> str:
+    '''
+    Projection cache key of rows start:stop of a point store. It changes
+    whenever the store is rewritten with different coordinates.
+    '''
+    name = os.path.basename(os.path.normpath(store['path']))
+    return f"{name}_{store['meta']['coords_sha256'][:16]}_{start}_{stop}"
+
+def prune_store_projections(tracts: TractIndex, store: dict, keys: list[str]) -> None:
+    '''
+    Delete the cached projections of a point store's chunks other than keys,
+    e.g. those of an earlier version of the store, which nothing will read again.
+    '''
+    name = os.path.basename(os.path.normpath(store['path']))
+    if tracts.cache_dir is None or not os.path.isdir(tracts.cache_dir):
+        return
+
+    keep = {projection_path(tracts.cache_dir, key, 'EPSG:4326', tracts.crs) for key in keys}
+    for file in os.listdir(tracts.cache_dir):
+        path = os.path.join(tracts.cache_dir, file)
+        if file.startswith(f'{name}_') and path not in keep:
+            os.remove(path)
+
+def _store_chunk_counts(index: TractIndex, path: str, start: int, stop: int,
+                        years: list[int], category_lookup: np.ndarray, n_years: int,
+                        n_categories: int) -> tuple[np.ndarray, np.ndarray]:
+    store = _mapped_store(path)
+    x, y = index.project(store['lon'][start:stop], store['lat'][start:stop],
+                         key=store_chunk_key(store, start, stop))
+    year_idx = axis_positions(store['year'][start:stop], years)
+    category_idx = category_lookup[store['category'][start:stop]]
+    return index.count_by(x, y, year_idx, category_idx, n_years, n_categories)
+
+def _count_store_chunk(*args) -> tuple[np.ndarray, np.ndarray]:
+    return _store_chunk_counts(_worker_index, *args)
+
+@lru_cache(maxsize=None)
+def _mapped_store(path: str) -> dict:
+    # Map each store once per process; the pages are shared between processes
+    return ps.open_point_store(path)
+
+def _map_chunks(tracts: TractIndex, f, chunks: Iterator[tuple], n_workers: int,
+                *args) -> Iterator:
+    '''
+    Yield f(*chunk, *args) for each chunk, run in a pool of n_workers
+    processes that each hold their own copy of tracts. Only 2 * n_workers
+    chunks are ever in flight, so the chunks never all have to fit in memory.
+    '''
+    wkb = shapely.to_wkb(tracts.geoms)
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                             initargs=(wkb, tracts.crs, tracts.cache_dir)) as pool:
+        chunks = iter(chunks)
+        in_flight = deque(pool.submit(f, *chunk, *args)
+                          for chunk in islice(chunks, 2 * n_workers))
+        while in_flight:
+            yield in_flight.popleft().result()
+            for chunk in islice(chunks, 1):
+                in_flight.append(pool.submit(f, *chunk, *args))
+
+def count_store_cube(tracts: TractIndex, path: str, years: list[int], categories: list[str],
+                     chunksize: int = CHUNK_SIZE,
+                     n_workers: int = N_WORKERS) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Count the points of a point store into tracts, building the tract x year
+    x category count cube in the same pass (see TractIndex.count_by), a
+    chunk of chunksize rows at a time over a pool of n_workers processes.
+    Workers are only sent which rows to count and map the store's arrays
+    themselves, so no point data is ever pickled between processes, and the
+    store never has to fit in memory. Chunk projections are cached by store
+    version and position, and those of older versions are deleted. The
+    store's categories are placed onto the cube's categories by name; any
+    the cube doesn't have are left out of the cube (but not the totals).
+
+    Returns (totals, cube).
+    '''
+    store = _mapped_store(path)
+    category_lookup = np.full(ps.NO_CATEGORY + 1, -1)
+    category_lookup[:len(store['meta']['categories'])] = \
+        axis_positions(store['meta']['categories'], categories)
+
+    starts = range(0, store['meta']['n_rows'], chunksize)
+    chunks = ((path, start, start + chunksize) for start in starts)
+    prune_store_projections(tracts, store, [store_chunk_key(store, start, start + chunksize)
+                                            for start in starts])
+    args = (list(years), category_lookup, len(years), len(categories))
+
+    if n_workers <= 1:
+        partials = (_store_chunk_counts(tracts, *chunk, *args) for chunk in chunks)
+    else:
+        partials = _map_chunks(tracts, _count_store_chunk, chunks, n_workers, *args)
+
+    totals = np.zeros(len(tracts), dtype=np.int64)
+    cube = np.zeros((len(tracts), len(years), len(categories)), dtype=np.int64)
+    for partial_totals, partial_cube in partials:
+        totals += partial_totals
+        cube += partial_cube
+    return totals, cube
+
+def save_count_cube(path: str, cube: np.ndarray, tract_ids: list,
+                    years: list[int], categories: list[str]) -> None:
+    '''
+    Save a tract x year x category count cube along with its axis labels as a
+    compressed .npz, so analyses can slice it without the point data.
+    '''
+    np.savez_compressed(path, counts=cube.astype(np.uint32),
+                        tracts=np.asarray(tract_ids, dtype=str),
+                        years=np.asarray(years, dtype=np.int16),
+                        categories=np.asarray(categories, dtype=str))
@@ -0,0 +1,75 @@
+### About: Reading and writing our intermediate datasets as (Geo)Parquet.
+### Point layers (cleaned crashes and 311s) are partitioned by city with
+### compact column types, tract layers are GeoParquet so they keep their
+### full column names. Readers take the columns and filters they need, so
+### nothing else is ever read off disk.
+
+import os
+import shutil
+import pandas as pd
+import geopandas as gpd
+
+CRASH_POINTS_LOC = '../data/crashes/crashes_18_22.parquet'
+REQUEST_POINTS_LOC = '../data/311/311_requests_18_22.parquet'
+CENS_CRASHES_LOC = '../data/shapes/censCrashes.parquet'
+CENSUS_FINAL_LOC = '../data/shapes/census_final.parquet'
+CENSUS_FINAL_FIXED_LOC = '../data/shapes/census_final_fixed.parquet'
+
+# Types of the cleaned point columns, anything else is left as is
+POINT_DTYPES = {
+    'ID': 'string',
+    'city': 'category',
+    'year': 'int16',
+    'latitude': 'float32',
+    'longitude': 'float32',
+    'request_type': 'category',
+}
+POINT_PARTITIONS = ['city']
+
+def typed_points(df: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Cast the cleaned point columns of df to their compact storage types.
+    '''
+    return df.astype({col: dtype for col, dtype in POINT_DTYPES.items() if col in df.columns})
+
+def _clear(path: str) -> None:
+    '''
+    Remove a previous dataset at path, since partitioned writes would
+    otherwise add files next to the old ones.
+    '''
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def write_points(df: pd.DataFrame, path: str, partition_cols: list[str] = POINT_PARTITIONS) -> None:
+    '''
+    Write a cleaned point layer to path as a Parquet dataset partitioned by
+    partition_cols, replacing whatever was there.
+    '''
+    _clear(path)
+    typed_points(df).to_parquet(path, index=False, partition_cols=partition_cols)
+
+def read_points(path: str, columns: list[str] = None, filters: list = None) -> pd.DataFrame:
+    '''
+    Read a point layer, only loading the given columns and the rows matching
+    filters, in pyarrow's format, e.g. [('city', 'in', ['Chicago', 'NYC'])].
+    Filters on the partition columns skip whole files.
+    '''
+    return pd.read_parquet(path, columns=columns, filters=filters)
+
+def write_tracts(gdf: gpd.GeoDataFrame, path: str) -> None:
+    '''
+    Write a tract layer to path as GeoParquet, replacing whatever was there.
+    '''
+    _clear(path)
+    gdf.to_parquet(path, index=False)
+
+def read_tracts(path: str, columns: list[str] = None, filters: list = None) -> gpd.GeoDataFrame:
+    '''
+    Read a tract layer, only loading the given columns (plus geometry) and
+    rows matching filters.
+    '''
+    if columns is not None and 'geometry' not in columns:
+        columns = [*columns, 'geometry']
+    return gpd.read_parquet(path, columns=columns, filters=filters)
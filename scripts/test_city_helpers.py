@@ -0,0 +1,100 @@
+### About: Checks the concurrent SODA pager against a stub server, so no
+### requests leave the machine. Run from the scripts folder with pytest.
+
+import random
+import time
+import pandas as pd
+import pytest
+
+import city_helpers as ch
+
+COLUMNS = ['unique_key', 'created_date', 'complaint_type']
+
+class StubResponse:
+    status_code = 200
+    text = ''
+
+    def __init__(self, url: str, rows: list[dict]):
+        self.url = url
+        self.rows = rows
+
+    def json(self) -> list[dict]:
+        return self.rows
+
+class StubSoda:
+    '''
+    Serves rows like a Socrata endpoint: a count(*) query, then $order,
+    $offset and $limit pages. Rows tied on every $order column come back in
+    a different order on every request, as they can from the real thing, and
+    requests finish in a random order.
+    '''
+
+    def __init__(self, rows: list[dict], seed: int = 0):
+        self.rows = rows
+        self.rng = random.Random(seed)
+        self.requests = []
+
+    def get(self, url: str, params: dict = None, timeout: float = None) -> StubResponse:
+        params = dict(params)
+        self.requests.append(params)
+        if params.get('$select') == 'count(*)':
+            return StubResponse(url, [{'count': str(len(self.rows))}])
+
+        rows = list(self.rows)
+        self.rng.shuffle(rows)
+        # Stable sorts from the last $order column to the first
+        for term in reversed(params['$order'].split(',')):
+            column, *direction = term.split()
+            rows.sort(key=lambda row: row[column], reverse=direction == ['DESC'])
+
+        time.sleep(self.rng.uniform(0, 0.005))
+        start, limit = int(params['$offset']), int(params['$limit'])
+        return StubResponse(url, [{col: row[col] for col in COLUMNS}
+                                  for row in rows[start:start + limit]])
+
+def fake_rows(n_rows: int) -> list[dict]:
+    '''
+    n_rows of 311s spread over only a few dates, so $order ties are everywhere.
+    '''
+    return [{':id': f'row-{i:05d}', 'unique_key': str(10_000 + i),
+             'created_date': f'2020-01-0{i % 3 + 1}T00:00:00',
+             'complaint_type': 'Street Light Condition'} for i in range(n_rows)]
+
+def expected(rows: list[dict]) -> pd.DataFrame:
+    rows = sorted(rows, key=lambda row: row[':id'])
+    rows.sort(key=lambda row: row['created_date'], reverse=True)
+    return pd.DataFrame(rows, columns=COLUMNS)
+
+def fetch(stub: StubSoda, order: str, monkeypatch, page_size: int = 7) -> list[pd.DataFrame]:
+    monkeypatch.setattr(ch, '_session', stub)
+    params = {'$limit': page_size, '$order': order}
+    return list(ch.iter_soda_pages_concurrent('https://stub/resource/x.json', params, COLUMNS,
+                                              key='unique_key', max_workers=3))
+
+def test_concurrent_pages_match_source(monkeypatch):
+    rows = fake_rows(100)
+    stub = StubSoda(rows)
+    pages = fetch(stub, 'created_date DESC, :id', monkeypatch)
+
+    # The count query splits the range into every page, and pages come back
+    # in offset order however the requests finish
+    offsets = sorted(int(p['$offset']) for p in stub.requests if '$offset' in p)
+    assert offsets == list(range(0, 100, 7))
+    assert [page.attrs['next_offset'] for page in pages] == list(range(7, 106, 7))
+
+    out = pd.concat(pages, ignore_index=True)
+    pd.testing.assert_frame_equal(out, expected(rows))
+
+def test_stub_breaks_pages_without_tie_break(monkeypatch):
+    # Without :id the ties reshuffle between pages, so rows go missing; this
+    # is what the tie break in every source's $order protects against
+    rows = fake_rows(100)
+    out = pd.concat(fetch(StubSoda(rows), 'created_date DESC', monkeypatch), ignore_index=True)
+    assert len(out) < len(rows)
+
+@pytest.mark.parametrize('page_size', [1, 50, 100, 250])
+def test_page_edges(monkeypatch, page_size):
+    rows = fake_rows(100)
+    out = pd.concat(fetch(StubSoda(rows, seed=page_size), 'created_date DESC, :id',
+                          monkeypatch, page_size), ignore_index=True)
+    pd.testing.assert_frame_equal(out, expected(rows))
@@ -0,0 +1,69 @@
+### About: Column at a time versions of the HOLC treatment rules used by
+### fix_final_data.py. Each rule set is an ordered list of (terms, value)
+### pairs: a row takes the value of the first pair with a term it contains,
+### so the list order is the precedence.
+
+import re
+import numpy as np
+import pandas as pd
+
+YES_LST = ['one', 'nominal', 'threat', 'three', 'slight', 'two', '6', 'scattered', 'many', 'yes', 'few', 'east', 'south', 'west', 'nom.', 'negro', '37', '2']
+# % is only really safe to use on this sample, as we hand verified it
+NO_LST = ['no', '0', 'none', '%']
+
+# Any yes term wins over any no term, and no match at all is a no
+VALID_RESPONSE_RULES = [(YES_LST, True), (NO_LST, False)]
+
+# Rough and tumble fixes from reading the all_fields text
+PATCHWORK_RULES = [(['no negro', 'no infiltration'], False), (['negro'], True)]
+
+def _rule_results(lowered: pd.Series, rules: list[tuple[list[str], bool]],
+                  default: bool) -> np.ndarray:
+    masks = [lowered.str.contains('|'.join(re.escape(term) for term in terms), regex=True)
+             .to_numpy(dtype=bool) for terms, _ in rules]
+    return np.select(masks, [value for _, value in rules], default=default).astype(bool)
+
+def first_match(values: pd.Series, rules: list[tuple[list[str], bool]],
+                default: bool = False) -> pd.Series:
+    '''
+    Give each value the result of the first rule with a term it contains,
+    once converted to a lower case string, or default if no rule matches.
+    Missing values are converted the way str() does, so None reads as
+    'none' (a yes, thanks to 'one') while NaN reads as 'nan'.
+    '''
+    # Only the distinct values ever get searched
+    codes, uniques = pd.factorize(values)
+    lowered = pd.Series(uniques, dtype=object).astype(str).str.lower()
+    missing = values[codes == -1].astype(str).str.lower()
+
+    results = np.zeros(len(values), dtype=bool)
+    results[codes != -1] = _rule_results(lowered, rules, default)[codes[codes != -1]]
+    results[codes == -1] = _rule_results(missing, rules, default)
+
+    return pd.Series(results, index=values.index)
+
+def valid_responses(values: pd.Series) -> pd.Series:
+    '''
+    Whether each negro_yes_or_no answer says there were black residents.
+    '''
+    return first_match(values, VALID_RESPONSE_RULES)
+
+def patchwork_fixes(values: pd.Series) -> pd.Series:
+    '''
+    Whether each all_fields text says there were black residents.
+    '''
+    return first_match(values, PATCHWORK_RULES)
+
+def tract_treatment(overlay: pd.DataFrame) -> pd.DataFrame:
+    '''
+    Given the tract x HOLC area overlay, return one row per GISJOIN with nyn,
+    whether any of the tract's areas had black residents.
+    '''
+    nyn = valid_responses(overlay.negro_yes_or_no) | patchwork_fixes(overlay.all_fields)
+    return nyn.groupby(overlay.GISJOIN, sort=False).any().rename('nyn').reset_index()
+
+def treatment_labels(grades: pd.Series, nyn: pd.Series) -> pd.Series:
+    '''
+    Label each tract with its grade, plus '_black' if it had black residents.
+    '''
+    return grades.astype(str) + np.where(nyn, '_black', '')